@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Created on Sun Sep 20 10:12:31 2026
+# @author: Fernando Camussi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" Conteo por lotes (sin interfaz gráfica)
+
+Ejemplo:
+    python batch.py --ppm 200 --model girasol.model -o resumen.csv vuelo1/
+"""
+
+from preprocessing import preprocessing
+from counting import counting
+from tiling import tiled_pipeline, TiledImage
+from counting_file import CountingFile
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import csv
+import os
+import sys
+import time
+import cv2 as cv
+
+
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png', '.tif', '.tiff', '.npy')
+
+STAGES = ['lectura', 'segmentacion', 'orientacion', 'rotacion', 'conteo']
+
+FIELDS = (['imagen', 'plantas', 'hileras', 'grupos', 'rotacion'] +
+          ['t_' + s for s in STAGES] + ['t_total', 'error'])
+
+
+def image_files(paths):
+    """ Expande una lista de ficheros y directorios en la lista de imágenes
+    a procesar
+
+    Argumentos:
+        paths -- lista de ficheros de imágenes o directorios que las contienen
+
+    Retorna: lista de nombres de ficheros de imágenes
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, f)
+                                for f in os.listdir(path)
+                                if f.lower().endswith(IMAGE_EXTENSIONS)))
+        else:
+            files.append(path)
+    return files
+
+
+def process(image_file, model_file, ppm, tile=None, overlap=None,
+            samples=None, mask_rotation=None, strip=None):
+    """ Procesa una imagen: segmentación, orientación, rotación y conteo
+
+    Argumentos:
+        image_file -- nombre del fichero de la imagen
+        model_file -- nombre del fichero del modelo
+        ppm -- pixeles por metro
+        tile -- lado de la tesela en pixeles para procesar por teselas
+                (None: se procesa la imagen completa)
+        overlap -- solapamiento entre teselas en pixeles
+        samples -- pixeles muestreados para el umbral global de las teselas
+        mask_rotation -- interpolación para rotar la máscara en lugar de
+                         segmentar de nuevo la imagen rotada (ver
+                         preprocessing). No se usa con tile
+        strip -- ancho en pixeles de las franjas para detectar hileras curvas
+                 (None: hileras rectas, ver rows_detection). No se usa con
+                 tile
+
+    Retorna: diccionario con los resultados y los tiempos de cada etapa
+    """
+    result = dict(imagen=image_file)
+    timings = {}
+    t_total = time.perf_counter()
+    try:
+        if tile is not None:
+            (total_plants,rects,total_rows,_,
+             orientation) = tiled_pipeline(image_file, model_file, ppm, tile,
+                                           overlap, samples, timings)
+            if orientation is None:
+                raise ValueError('Falló la detección de la orientación.')
+            result.update(plantas=total_plants,
+                          hileras=total_rows,
+                          grupos=len(rects),
+                          rotacion='%.2f' % -orientation)
+            return result
+        t = time.perf_counter()
+        if image_file.lower().endswith('.npy'):
+            # OpenCV no lee .npy, se carga completo como en tiling (BGR)
+            image = TiledImage(image_file)
+            image = image.window(0, image.shape[0], 0, image.shape[1])
+        else:
+            image = cv.imread(image_file, cv.IMREAD_COLOR)
+        timings['lectura'] = time.perf_counter() - t
+        if image is None:
+            raise ValueError('No se pudo leer la imagen.')
+        if not CountingFile.isRGB(image):
+            raise ValueError('La imagen no es RGB.')
+        _,mask,orientation = preprocessing(image, ppm, timings, mask_rotation,
+                                           rotate_image=False)
+        if orientation is None:
+            raise ValueError('Falló la detección de la orientación.')
+        t = time.perf_counter()
+        total_plants,rects,total_rows,_ = counting(mask, model_file, ppm,
+                                                   strip)
+        timings['conteo'] = time.perf_counter() - t
+        result.update(plantas=total_plants,
+                      hileras=total_rows,
+                      grupos=len(rects),
+                      rotacion='%.2f' % -orientation)
+    except Exception as e:
+        result['error'] = str(e)
+    finally:
+        for stage,seconds in timings.items():
+            result['t_' + stage] = '%.3f' % seconds
+        result['t_total'] = '%.3f' % (time.perf_counter() - t_total)
+    return result
+
+
+def batch(files, model_file, ppm, summary_file, workers=None, tile=None,
+          overlap=None, samples=None, mask_rotation=None, strip=None):
+    """ Procesa un conjunto de imágenes en paralelo y escribe un resumen
+    con una fila por imagen
+
+    Argumentos:
+        files -- lista de nombres de ficheros de imágenes
+        model_file -- nombre del fichero del modelo
+        ppm -- pixeles por metro
+        summary_file -- nombre del fichero CSV de resumen
+        workers -- cantidad de procesos (None: cantidad de CPUs)
+        tile -- lado de la tesela en pixeles (None: sin teselas)
+        overlap -- solapamiento entre teselas en pixeles
+        samples -- pixeles muestreados para el umbral global de las teselas
+                   (None: se recorre toda la imagen)
+        mask_rotation -- interpolación para rotar la máscara en lugar de
+                         segmentar de nuevo la imagen rotada
+        strip -- ancho en pixeles de las franjas para detectar hileras curvas
+
+    Retorna: lista de diccionarios con los resultados
+    """
+    results = []
+    n = len(files)
+    with open(summary_file, 'w', newline='') as f, \
+         ProcessPoolExecutor(max_workers=workers,
+                             initializer=__init_worker) as executor:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        # map conserva el orden de las imágenes de entrada
+        for i,result in enumerate(executor.map(process, files,
+                                               [model_file]*n, [ppm]*n,
+                                               [tile]*n, [overlap]*n,
+                                               [samples]*n,
+                                               [mask_rotation]*n,
+                                               [strip]*n)):
+            writer.writerow(result)
+            f.flush()
+            results.append(result)
+            print('[%d/%d] %s: %s' % (i+1, n, result['imagen'],
+                                      result.get('error') or
+                                      '%d plantas' % result['plantas']),
+                  file=sys.stderr)
+    return results
+
+
+def __init_worker():
+    # Cada proceso usa un solo hilo de OpenCV para no sobresuscribir la CPU
+    cv.setNumThreads(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Conteo de plantas de girasol por lotes.')
+    parser.add_argument('images', nargs='+',
+                        help='imágenes o directorios con imágenes')
+    parser.add_argument('--ppm', type=int, required=True,
+                        help='pixeles por metro')
+    parser.add_argument('-m', '--model', required=True,
+                        help='fichero del modelo (.model)')
+    parser.add_argument('-o', '--output', default='resumen.csv',
+                        help='fichero CSV de resumen (por defecto: '
+                             '%(default)s)')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='cantidad de procesos (por defecto: cantidad '
+                             'de CPUs)')
+    parser.add_argument('--mask-rotation', choices=['nearest', 'bilinear'],
+                        default=None,
+                        help='rota la máscara con la interpolación dada en '
+                             'lugar de rotar la imagen y segmentarla de nuevo '
+                             '(más rápido, no se puede usar con --tile)')
+    parser.add_argument('--strip', type=int, default=None,
+                        help='busca las hileras por separado en franjas '
+                             'verticales de STRIP pixeles de ancho y las '
+                             'enlaza, para hileras levemente curvas (no se '
+                             'puede usar con --tile)')
+    parser.add_argument('--tile', type=int, default=None,
+                        help='procesa por teselas de TILE pixeles de lado, '
+                             'para ortomosaicos que no entran en memoria')
+    parser.add_argument('--overlap', type=int, default=None,
+                        help='solapamiento entre teselas en pixeles (por '
+                             'defecto: PPM)')
+    parser.add_argument('--samples', type=int, default=None,
+                        help='con --tile, cantidad de pixeles muestreados al '
+                             'azar para calcular el umbral de segmentación '
+                             '(por defecto se recorre toda la imagen)')
+    args = parser.parse_args(argv)
+    # El procesamiento por teselas rota cada ventana de la máscara y detecta
+    # las hileras con un único perfil
+    if args.tile is not None:
+        for option,value in (('--mask-rotation', args.mask_rotation),
+                             ('--strip', args.strip)):
+            if value is not None:
+                parser.error('%s no se puede usar con --tile' % option)
+
+    files = image_files(args.images)
+    if not files:
+        parser.error('no se encontraron imágenes')
+    results = batch(files, args.model, args.ppm, args.output, args.workers,
+                    args.tile, args.overlap, args.samples,
+                    args.mask_rotation, args.strip)
+    errors = sum(1 for r in results if r.get('error'))
+    print('Se procesaron %d imágenes (%d con errores). Resumen en %s.' %
+          (len(results), errors, args.output), file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,791 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Created on Wed Sep 23 20:03:31 2026
+# @author: Fernando Camussi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" Benchmarks
+
+Compara las implementaciones actuales con las anteriores, que se conservan
+aquí como referencia. Ejemplo:
+    python benchmark.py exg --mp 20 50 100
+"""
+
+from segmentation import segmentation
+from preprocessing import preprocessing
+from counting import counting
+from rows_orientation import rows_orientation, METHODS
+from rows_detection import rows_detection, rows_centers, __uncontained
+from descriptors import Descriptors
+from blobs import Blobs
+from packed_mask import PackedMask
+from model import Model
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+import cv2 as cv
+import numpy as np
+import pandas as pd
+
+
+def measure(fun, *args):
+    """ Ejecuta una función midiendo el tiempo y la memoria
+
+    Argumentos:
+        fun -- función a ejecutar
+        args -- argumentos de la función
+
+    Retorna: resultado de la función, tiempo en segundos y pico de memoria
+             en bytes reservada por NumPy durante la ejecución
+    """
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    t = time.perf_counter()
+    result = fun(*args)
+    t = time.perf_counter() - t
+    _,peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (result,t,peak)
+
+
+def check(ok, message):
+    """ Termina con error si falla una comparación contra la implementación
+    anterior
+
+    Argumentos:
+        ok -- resultado de la comparación
+        message -- descripción de la diferencia
+    """
+    if not ok:
+        sys.exit('ERROR: %s' % message)
+
+
+def bench_exg(args):
+    """ Compara la segmentación con el ExG por bandas int16 contra la
+    implementación anterior con arrays int64 sobre imágenes aleatorias
+    """
+    rng = np.random.default_rng(0)
+    print('%6s %12s %12s %12s %12s %8s' % ('MP', 't_ant (s)', 't_act (s)',
+                                           'mem_ant (MB)', 'mem_act (MB)',
+                                           'iguales'))
+    for mp in args.mp:
+        w = int(np.sqrt(mp*1e6*4/3))
+        h = int(mp*1e6/w)
+        image = rng.integers(0, 256, (h,w,3), np.uint8)
+        mask_old,t_old,mem_old = measure(__legacy_segmentation, image)
+        del mask_old
+        mask,t,mem = measure(segmentation, image)
+        mask_old = __legacy_segmentation(image)
+        print('%6d %12.3f %12.3f %12.1f %12.1f %8s' %
+              (mp, t_old, t, mem_old/2**20, mem/2**20,
+               (mask == mask_old).all()))
+        del image,mask,mask_old
+
+
+def bench_rotate_mask(args):
+    """ Compara los conteos y tiempos de segmentar de nuevo la imagen
+    rotada contra rotar directamente la máscara
+    """
+    modes = [None, 'nearest', 'bilinear']
+    names = ['resegmentar', 'nearest', 'bilinear']
+    print('%-20s' % 'imagen' +
+          ''.join('%14s' % ('%s (s)' % n[:10]) for n in names) +
+          ''.join('%12s' % n[:10] for n in names))
+    diffs = [[] for _ in modes]
+    for image_file in args.images:
+        image = cv.imread(image_file, cv.IMREAD_COLOR)
+        times = []
+        counts = []
+        for mode in modes:
+            t = time.perf_counter()
+            _,mask,orientation = preprocessing(image, args.ppm, None, mode,
+                                               rotate_image=False)
+            times.append(time.perf_counter() - t)
+            if orientation is None:
+                counts.append(0)
+            else:
+                counts.append(counting(mask, args.model, args.ppm)[0])
+        for i in range(len(modes)):
+            diffs[i].append(counts[i] - counts[0])
+        print('%-20s' % image_file[-20:] +
+              ''.join('%14.3f' % t for t in times) +
+              ''.join('%12d' % c for c in counts))
+    for i in range(1, len(modes)):
+        d = np.array(diffs[i])
+        print('%s: diferencia media %.2f plantas, máxima %d' %
+              (names[i], d.mean(), np.abs(d).max()))
+
+
+def synthetic_field(h, w, ppm, angle, density=1., spacing=0.7,
+                    plant_spacing=0.25, seed=0, bend=0.):
+    """ Genera la máscara de un campo sintético con hileras rectas
+
+    Argumentos:
+        h, w -- dimensiones de la máscara
+        ppm -- pixeles por metro
+        angle -- orientación de las hileras en grados (con el criterio de
+                 rows_orientation)
+        density -- fracción de plantas presentes (para campos ralos)
+        spacing -- distancia entre hileras en metros
+        plant_spacing -- distancia media entre plantas en metros
+        seed -- semilla
+        bend -- desplazamiento lateral en metros de las hileras en los
+                extremos respecto del centro (hileras curvas)
+
+    Retorna: máscara
+    """
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((h,w), np.uint8)
+    a = np.radians(angle)
+    r = np.array([np.cos(a), -np.sin(a)])
+    n = np.array([np.sin(a), np.cos(a)])
+    c = np.array([w/2, h/2])
+    L = np.hypot(h, w) / 2
+    for s in np.arange(-L, L, spacing*ppm):
+        t = -L
+        while t < L:
+            t += rng.uniform(0.5, 1.5) * plant_spacing * ppm
+            if rng.random() > density:
+                continue
+            x,y = c + t*r + (s + bend*ppm*(t/L)**2 +
+                             rng.normal(0, 0.02*ppm))*n
+            if 0 <= x < w and 0 <= y < h:
+                radius = rng.uniform(0.04, 0.08) * ppm
+                cv.ellipse(mask, (int(x),int(y)),
+                           (int(radius*1.3)+1,int(radius)+1),
+                           rng.uniform(0, 180), 0, 360, 255, -1)
+    return mask
+
+
+def bench_orientation(args):
+    """ Compara los métodos de rows_orientation sobre campos sintéticos
+    con hileras rotadas, reportando el error angular y el tiempo
+    """
+    rng = np.random.default_rng(args.seed)
+    configs = [(m, args.ppm, False) for m in METHODS]
+    configs += [(m, args.ppm, True) for m in METHODS]
+    configs += [('autocorrelation', None, False)]
+    names = ['%s%s' % (m, ' +fino' if refine else
+                       ' (sin pirámide)' if ppm is None else '')
+             for m,ppm,refine in configs]
+    for density in args.density:
+        errors = [[] for _ in configs]
+        times = [[] for _ in configs]
+        for i in range(args.fields):
+            angle = rng.uniform(-45, 45)
+            mask = synthetic_field(args.size, args.size, args.ppm, angle,
+                                   density, seed=i)
+            for j,(method,ppm,refine) in enumerate(configs):
+                t = time.perf_counter()
+                o = rows_orientation(mask, ppm=ppm, refine=refine,
+                                     method=method)
+                times[j].append(time.perf_counter() - t)
+                if o is None:
+                    errors[j].append(np.nan)
+                else:
+                    errors[j].append(abs((o - angle + 90) % 180 - 90))
+        print('Densidad %.2f (%d campos de %dx%d a %d ppm)' %
+              (density, args.fields, args.size, args.size, args.ppm))
+        print('%-34s %10s %10s %8s %10s' % ('método', 'err_med', 'err_max',
+                                            'fallas', 't_med (s)'))
+        for j,name in enumerate(names):
+            e = np.array(errors[j])
+            ok = e[~np.isnan(e)]
+            print('%-34s %10.3f %10.3f %8d %10.3f' %
+                  (name, ok.mean() if len(ok) else np.nan,
+                   ok.max() if len(ok) else np.nan, np.isnan(e).sum(),
+                   np.mean(times[j])))
+        print()
+
+
+def bench_autocorrelation(args):
+    """ Compara rows_orientation contra la implementación anterior (que
+    calcula la auto-correlación completa con scipy.signal.correlate) sobre
+    campos sintéticos con hileras rotadas, reportando el tiempo, el pico de
+    memoria de NumPy/SciPy y la diferencia de ángulo con la anterior. Se
+    mide la llamada sin argumentos (mismo resultado que la anterior) y la
+    que usa el programa, con la pirámide y el refinamiento
+    """
+    rng = np.random.default_rng(args.seed)
+    configs = [('anterior', __legacy_orientation),
+               ('actual', rows_orientation),
+               ('actual lags=%g' % args.lags,
+                lambda m: rows_orientation(m, lags=args.lags)),
+               ('actual ppm +fino',
+                lambda m: rows_orientation(m, ppm=args.ppm, refine=True))]
+    # La primera llamada incluye la importación de scipy
+    warmup = synthetic_field(200, 200, args.ppm, 0)
+    for _,fun in configs:
+        fun(warmup)
+    print('%-22s %10s %12s %12s %12s' % ('', 't_med (s)', 'mem_max (MB)',
+                                         'dif_med (°)', 'dif_max (°)'))
+    for size in args.size:
+        times = [[] for _ in configs]
+        mems = [[] for _ in configs]
+        diffs = [[] for _ in configs]
+        for i in range(args.fields):
+            angle = rng.uniform(-45, 45)
+            mask = synthetic_field(size, size, args.ppm, angle, seed=i)
+            ref = None
+            for j,(_,fun) in enumerate(configs):
+                o,t,mem = measure(fun, mask)
+                times[j].append(t)
+                mems[j].append(mem)
+                if j == 0:
+                    ref = o
+                elif o is None or ref is None:
+                    diffs[j].append(np.nan)
+                else:
+                    diffs[j].append(abs((o - ref + 90) % 180 - 90))
+        print('%dx%d (%d campos)' % (size, size, args.fields))
+        for j,(name,_) in enumerate(configs):
+            d = np.array(diffs[j])
+            print('%-22s %10.3f %12.1f %12s %12s' %
+                  (name, np.mean(times[j]), max(mems[j])/2**20,
+                   '%.4f' % d.mean() if j > 0 else '-',
+                   '%.4f' % d.max() if j > 0 else '-'))
+    check(np.nanmax(diffs[1]) < args.tol,
+          'rows_orientation difiere de la implementación anterior en más '
+          'de %g°' % args.tol)
+
+
+def bench_rows_detection(args):
+    """ Compara rows_detection contra la implementación anterior (que
+    calcula los momentos de cada contorno para cada hilera) sobre campos
+    sintéticos con hileras horizontales
+    """
+    # La primera llamada incluye la importación de scipy.signal
+    rows_centers(synthetic_field(200, 200, args.ppm, 0), args.ppm)
+    print('%8s %8s %8s %12s %12s %8s' % ('lado', 'hileras', 'objetos',
+                                         't_ant (s)', 't_act (s)',
+                                         'iguales'))
+    for size in args.size:
+        mask = synthetic_field(size, size, args.ppm, 0, seed=size)
+        t = time.perf_counter()
+        result = rows_detection(mask, args.ppm)
+        t = time.perf_counter() - t
+        n = len(cv.findContours(mask, cv.RETR_EXTERNAL,
+                                cv.CHAIN_APPROX_NONE)[0])
+        if args.legacy:
+            t_old = time.perf_counter()
+            result_old = __legacy_rows_detection(mask, args.ppm)
+            t_old = time.perf_counter() - t_old
+            same = (result[1:] == result_old[1:] and
+                    len(result[0]) == len(result_old[0]) and
+                    all((a == b).all() for a,b in zip(result[0].contours(),
+                                                      result_old[0])))
+        else:
+            t_old = np.nan
+            same = '-'
+        print('%8d %8d %8d %12.3f %12.3f %8s' % (size, result[1], n, t_old,
+                                                 t, same))
+        check(not args.legacy or same,
+              'la detección de las hileras no coincide con la '
+              'implementación anterior (lado %d)' % size)
+
+
+def bench_uncontained(args):
+    """ Compara la eliminación de los objetos contenidos en x de
+    rows_detection (barrido ordenado) contra la pasada voraz anterior sobre
+    conjuntos aleatorios de intervalos con muchos empates y anidamientos
+    """
+    rng = np.random.default_rng(args.seed)
+    mismatches = 0
+    t = t_old = 0.
+    for _ in range(args.sets):
+        n = rng.integers(0, args.max_n+1)
+        # Extremos en un rango chico para que haya intervalos iguales, con
+        # el mismo comienzo o el mismo final
+        span = rng.integers(1, 20)
+        x1 = rng.integers(0, span, n)
+        x2 = x1 + rng.integers(0, span, n)
+        t0 = time.perf_counter()
+        keep = np.flatnonzero(__uncontained(x1, x2))
+        t1 = time.perf_counter()
+        keep_old = __legacy_uncontained(x1, x2)
+        t_old += time.perf_counter() - t1
+        t += t1 - t0
+        if not np.array_equal(keep, keep_old):
+            mismatches += 1
+            if mismatches == 1:
+                print('x1 = %s\nx2 = %s' % (list(x1), list(x2)))
+    print('%d conjuntos de hasta %d intervalos: %d diferencias' %
+          (args.sets, args.max_n, mismatches))
+    print('t_ant %.3f s, t_act %.3f s' % (t_old, t))
+    check(mismatches == 0, 'la eliminación de los objetos contenidos no '
+                           'coincide con la implementación anterior')
+
+
+def bench_strips(args):
+    """ Compara la detección de hileras con un único perfil contra el modo
+    por franjas sobre campos sintéticos con hileras cada vez más curvas
+    """
+    print('%9s %10s %10s %10s %10s %10s' % ('curva (m)', 'objetos',
+                                            'hileras', 'asignados',
+                                            'hileras_f', 'asignados_f'))
+    for bend in args.bend:
+        mask = synthetic_field(args.size, args.size, args.ppm, 0, bend=bend)
+        n = len(cv.findContours(mask, cv.RETR_EXTERNAL,
+                                cv.CHAIN_APPROX_NONE)[0])
+        contours,rows,_ = rows_detection(mask, args.ppm)
+        t = time.perf_counter()
+        contours_s,rows_s,_ = rows_detection(mask, args.ppm, args.strip,
+                                             args.threads)
+        t = time.perf_counter() - t
+        print('%9.2f %10d %10d %10d %10d %10d   (%.3f s)' %
+              (bend, n, rows, len(contours), rows_s, len(contours_s), t))
+
+
+def bench_descriptors(args):
+    """ Compara Descriptors.array contra el cálculo anterior contorno por
+    contorno y verifica que los valores coincidan (error relativo menor que
+    args.tol y mismos valores con cualquier cantidad de hilos o procesos).
+    Para medir la escalabilidad reporta la fracción del tiempo que se
+    calcula con el GIL tomado (envolventes convexas objeto por objeto), que
+    limita la aceleración con hilos, y la aceleración con hilos y con
+    procesos respecto del cálculo en serie
+    """
+    print('núcleos: %d' % os.cpu_count())
+    print('%-20s %8s %12s %12s %14s %10s' % ('máscara', 'objetos',
+                                             't_ant (s)', 't_act (s)',
+                                             'err_rel_max', 'acel'))
+    failed = []
+    for mask_file in args.masks:
+        if mask_file.isdigit():
+            mask = synthetic_field(int(mask_file), int(mask_file), args.ppm,
+                                   0)
+        else:
+            mask = cv.imread(mask_file, cv.IMREAD_GRAYSCALE)
+        blobs = Blobs.fromMask(mask)
+        t_old = time.perf_counter()
+        old = np.array([__legacy_descriptors(cnt, args.ppm)
+                        for cnt in blobs.contours()]).reshape(-1, 10)
+        t_old = time.perf_counter() - t_old
+        t1 = time.perf_counter()
+        new = Descriptors.array(blobs, args.ppm)
+        t1 = time.perf_counter() - t1
+        err = np.abs(new - old) / np.maximum(np.abs(old), 1e-12)
+        print('%-20s %8d %12.3f %12.3f %14.2e' % (mask_file[-20:], len(blobs),
+                                                  t_old, t1,
+                                                  err.max(initial=0)))
+        if not err.max(initial=0) < args.tol:
+            failed.append(mask_file)
+        t = time.perf_counter()
+        Blobs.fromContours([cv.convexHull(cnt) for cnt in blobs.contours()])
+        gil = (time.perf_counter() - t) / t1
+        print('%-20s %8s %12s %12s %14s %10s' %
+              ('  con GIL: %.0f%%' % (100*gil), '', '', '', '',
+               'máx %.1f' % (1/gil) if gil > 0 else ''))
+        for kind in ('threads', 'processes'):
+            for workers in args.threads:
+                t = time.perf_counter()
+                par = Descriptors.array(blobs, args.ppm, **{kind: workers})
+                t = time.perf_counter() - t
+                same = np.array_equal(par, new)
+                print('%-20s %8s %12s %12.3f %14s %10.2f' %
+                      ('  %d %s' % (workers, 'hilos' if kind == 'threads'
+                                    else 'procesos'),
+                       '', '', t, 'iguales' if same else 'DISTINTOS', t1/t))
+                if not same:
+                    failed.append('%s (%d %s)' % (mask_file, workers, kind))
+    check(not failed, 'los descriptores no coinciden con la implementación '
+                      'anterior en: %s' % ', '.join(failed))
+
+
+def bench_descriptors_io(args):
+    """ Compara la carga de ficheros de descriptores en CSV y en el formato
+    binario por columnas (.npz)
+    """
+    rng = np.random.default_rng(0)
+    columns = Descriptors.compute(Blobs.fromMask(np.zeros((1,1), np.uint8)),
+                                  1, []).columns
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = {'csv': [], 'npz': []}
+        for i in range(args.files):
+            df = pd.DataFrame(rng.random((args.rows,len(columns))),
+                              columns=columns)
+            df[columns[-1]] = rng.integers(1, 5, args.rows)
+            for ext in files:
+                files[ext].append(os.path.join(tmp_dir, '%d.%s' % (i, ext)))
+                Descriptors.save(files[ext][-1], df)
+        print('%d ficheros de %d filas' % (args.files, args.rows))
+        data = {}
+        for ext in files:
+            t = time.perf_counter()
+            data[ext] = Descriptors.load(files[ext]).values
+            t = time.perf_counter() - t
+            size = sum(map(os.path.getsize, files[ext]))
+            print('%4s: %8.3f s %10.1f MB' % (ext, t, size/2**20))
+        t = time.perf_counter()
+        pd.concat(map(pd.read_csv, files['csv']))
+        print('CSV con pd.concat (anterior): %.3f s' %
+              (time.perf_counter() - t))
+        print('iguales: %s' % np.allclose(data['csv'], data['npz'],
+                                          rtol=1e-15))
+
+
+def bench_train(args):
+    """ Compara el entrenamiento por bloques (Model.train) contra cargar
+    todos los ficheros y generar el modelo (Model.generate)
+    """
+    rng = np.random.default_rng(0)
+    columns = Descriptors.compute(Blobs.fromMask(np.zeros((1,1), np.uint8)),
+                                  1, []).columns
+    w = rng.normal(size=len(columns)-1)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = []
+        for i in range(args.files):
+            X = rng.random((args.rows,len(columns)-1))
+            df = pd.DataFrame(X, columns=columns[:-1])
+            df[columns[-1]] = np.round(X @ w + rng.normal(size=args.rows))
+            files.append(os.path.join(tmp_dir, '%d.npz' % i))
+            Descriptors.save(files[-1], df)
+        (model,info),t,mem = measure(
+            lambda: Model.generate(Descriptors.load(files)))
+        (model2,info2),t2,mem2 = measure(Model.train, files)
+        print('%d ficheros de %d filas' % (args.files, args.rows))
+        print('%-10s %10s %14s %12s' % ('', 't (s)', 'mem (MB)', 'R2'))
+        print('%-10s %10.3f %14.1f %12.6f' % ('generate', t, mem/2**20,
+                                              info['R2']))
+        print('%-10s %10.3f %14.1f %12.6f' % ('train', t2, mem2/2**20,
+                                              info2['R2']))
+        print('diferencia máxima de coeficientes: %.2e' %
+              np.abs(model['coef'] - model2['coef']).max())
+
+
+def bench_packed_mask(args):
+    """ Compara la máscara densa (uint8) contra la empaquetada por bits:
+    memoria, conversiones, sumas por fila y tamaño en disco
+    """
+    print('%8s %10s %10s %10s %10s %10s %10s %8s' % (
+        'lado', 'mem (MB)', 'bits (MB)', 'pack (s)', 'unpack (s)',
+        'sum (s)', 'bits (s)', 'iguales'))
+    disk = []
+    for size in args.size:
+        mask = synthetic_field(size, size, args.ppm, 0, seed=size)
+        packed,t_pack,_ = measure(PackedMask.fromDense, mask)
+        dense,t_unpack,_ = measure(packed.toDense)
+        sums,t_sum,_ = measure(lambda: mask.sum(axis=1, dtype=np.int64))
+        bit_sums,t_bits,_ = measure(packed.rowSums)
+        same = (dense == mask).all() and (sums == 255*bit_sums).all()
+        print('%8d %10.1f %10.1f %10.3f %10.3f %10.3f %10.3f %8s' % (
+            size, mask.nbytes/2**20, packed.bits.nbytes/2**20, t_pack,
+            t_unpack, t_sum, t_bits, same))
+        disk.append((size,len(cv.imencode('.tif', mask)[1]),
+                     len(cv.imencode('.png', mask)[1]),
+                     len(zlib.compress(packed.bits.tobytes()))))
+    print('\n%8s %12s %12s %12s' % ('lado', 'TIFF (MB)', 'PNG (MB)',
+                                    'bits (MB)'))
+    for size,tif,png,bits in disk:
+        print('%8d %12.2f %12.2f %12.2f' % (size, tif/2**20, png/2**20,
+                                            bits/2**20))
+
+
+def bench_imports(args):
+    """ Mide el tiempo de importación de cada módulo en un intérprete nuevo
+    (arranque en frío) e indica qué bibliotecas pesadas quedan cargadas
+    """
+    heavy = ('PyQt5', 'pandas', 'scipy', 'sklearn', 'matplotlib')
+    code = ('import sys, time\n'
+            't = time.perf_counter()\n'
+            'import %s\n'
+            't = time.perf_counter() - t\n'
+            'print(t, *[m for m in %r if m in sys.modules])')
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    print('%-16s %10s %10s  %s' % ('módulo', 'import (s)', 'total (s)',
+                                   'bibliotecas cargadas'))
+    for module in args.modules:
+        best = None
+        for _ in range(args.repeat):
+            t = time.perf_counter()
+            p = subprocess.run([sys.executable, '-c', code % (module, heavy)],
+                               cwd=cwd, capture_output=True, text=True)
+            t = time.perf_counter() - t
+            if p.returncode != 0:
+                best = None
+                break
+            out = p.stdout.split()
+            if best is None or float(out[0]) < best[0]:
+                best = (float(out[0]),t,out[1:])
+        if best is None:
+            print('%-16s %s' % (module, p.stderr.strip().splitlines()[-1]))
+        else:
+            print('%-16s %10.3f %10.3f  %s' % (module, best[0], best[1],
+                                               ' '.join(best[2]) or '-'))
+
+
+def __legacy_descriptors(contour, ppm):
+    # Descriptores de un contorno (implementación anterior)
+    _,_,w,h = cv.boundingRect(contour)
+    area = cv.contourArea(contour)
+    perimeter = cv.arcLength(contour, True)
+    hull = cv.convexHull(contour)
+    hull_area = cv.contourArea(hull)
+    hull_perimeter = cv.arcLength(hull, True)
+    z = np.matrix(contour[:,0,:])
+    K = z.shape[0]
+    z_ = np.sum(z,axis=0)/K
+    C = np.sum([np.matmul((zk-z_).T,zk-z_) for zk in z],axis=0)/(K-1)
+    eigval,_ = np.linalg.eig(C)
+    eccentricity = np.sqrt(1-(min(eigval)/max(eigval))**2)
+    return [area/ppm**2, w*h/ppm**2, perimeter/ppm, (2*w+2*h)/ppm,
+            perimeter**2/area, eccentricity, w/h, area/(w*h),
+            hull_perimeter/perimeter, area/hull_area]
+
+
+def __legacy_rows_detection(mask, ppm):
+    # Detección de las filas asignando los objetos con un doble bucle sobre
+    # hileras y contornos (implementación anterior)
+    def centroid(cnt):
+        M = cv.moments(cnt)
+        return (int(M['m10']/M['m00']),int(M['m01']/M['m00']))
+    def in_bbx(cnt1, cnt2):
+        [x1,_,w1,_] = cv.boundingRect(cnt1)
+        [x2,_,w2,_] = cv.boundingRect(cnt2)
+        return x2 <= x1 and x1+w1 <= x2+w2
+    row_centers,widths = rows_centers(mask, ppm)
+    contours,_ = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)
+    rows = [[] for _ in range(len(row_centers))]
+    for i in range(len(rows)):
+        for cnt in contours:
+            cen = centroid(cnt)
+            if (row_centers[i] - widths[i] < cen[1] and
+                cen[1] < row_centers[i] + widths[i]):
+                rows[i].append(cnt)
+    rows2 = [[] for _ in range(len(rows))]
+    for i in range(len(rows)):
+        for j in range(len(rows[i])):
+            if len([x for x in rows2[i] if in_bbx(rows[i][j],x)]) == 0:
+                e = [k for k in range(len(rows2[i]))
+                         if in_bbx(rows2[i][k],rows[i][j])]
+                if len(e) > 0:
+                    rows2[i] = [rows2[i][k] for k in range(len(rows2[i]))
+                                    if k not in e]
+                rows2[i].append(rows[i][j])
+    rows3 = [[] for _ in range(len(rows2))]
+    for i in range(len(rows2)):
+        rows2[i] = sorted(rows2[i], key=lambda x: centroid(x)[0])
+        for cnt in rows2[i]:
+            cen = centroid(cnt)
+            if len(rows3[i]) < 3:
+                rows3[i].append(cnt)
+            else:
+                row_centers[i] = sum([centroid(c)[1] for c in
+                                          rows3[i][-3:len(rows3[i])]])/3
+                if (row_centers[i] - widths[i]/2 < cen[1] and
+                    cen[1] < row_centers[i] + widths[i]/2):
+                    rows3[i].append(cnt)
+    centroids = [list(map(centroid, r)) for r in rows3]
+    centroids = [sorted(r, key=lambda x: x[0]) for r in centroids]
+    lines = [[list(cs[c]+cs[c+1]) for c in range(len(cs)-1)]
+             for cs in centroids]
+    lines = [l for ls in lines for l in ls]
+    contours2 = [x for r in rows3 for x in r]
+    return (contours2,len(row_centers),lines)
+
+
+def __legacy_uncontained(x1, x2):
+    # Índices de los intervalos [x1,x2] que no están contenidos en ningún
+    # otro, con la pasada voraz anterior: cada intervalo se agrega si no
+    # está contenido en uno de los ya agregados y se quitan los que él
+    # contiene
+    in_bbx = lambda a, b: x1[b] <= x1[a] and x2[a] <= x2[b]
+    kept = []
+    for j in range(len(x1)):
+        if not any(in_bbx(j, k) for k in kept):
+            kept = [k for k in kept if not in_bbx(k, j)]
+            kept.append(j)
+    return np.array(kept, int)
+
+
+def __legacy_segmentation(image):
+    # Segmentación con ExG en int64 (implementación anterior)
+    R = image[:,:,2].astype(int)
+    G = image[:,:,1].astype(int)
+    B = image[:,:,0].astype(int)
+    ExG = 2*G-R-B
+    ExG[ExG>255] = 255
+    ExG[ExG<0] = 0
+    ExG = ExG.astype('uint8')
+    _,mask = cv.threshold(ExG, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
+    return mask
+
+
+def __legacy_orientation(mask, h_crop=4000, w_crop=4000):
+    # Orientación con la auto-correlación completa de scipy.signal.correlate
+    # (implementación anterior)
+    from scipy.signal import correlate
+    [h,w] = mask.shape
+    h_crop = min(h_crop, h)
+    w_crop = min(w_crop, w)
+    h_s = int((h-h_crop)/2)
+    w_s = int((w-w_crop)/2)
+    mask = mask[h_s:h_s+h_crop,
+                w_s:w_s+w_crop]
+    mask = cv.normalize(mask, None, 0, 1, cv.NORM_MINMAX, cv.CV_32F)
+    xc = correlate(mask, mask, mode = 'full', method='fft')
+    xc = cv.normalize(xc, None, 0, 255, cv.NORM_MINMAX, cv.CV_8U)
+    _,xc_bin = cv.threshold(xc, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
+    [h,w] = xc_bin.shape
+    center = (int(w/2), int(h/2))
+    contours,_ = cv.findContours(xc_bin, cv.RETR_TREE,
+                                 cv.CHAIN_APPROX_NONE)
+    cnt_center = None
+    for cnt in contours:
+        if cv.pointPolygonTest(cnt, center , False) >= 0:
+            cnt_center = cnt
+    if cnt_center is None:
+        return None
+    z = cnt_center[:,0,:].astype(np.float64)
+    z -= z.mean(axis=0)
+    C = z.T @ z / (len(z)-1)
+    eigval,eigvec = np.linalg.eig(C)
+    v = eigvec[np.where(eigval == np.abs(eigval).max())][0]
+    return np.degrees(np.arctan2(v[1],v[0]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    p = subparsers.add_parser('exg', help='segmentación (ExG)')
+    p.add_argument('--mp', type=int, nargs='+', default=[20,50,100],
+                   help='tamaños de imagen en megapixeles')
+    p.set_defaults(fun=bench_exg)
+
+    p = subparsers.add_parser('rotate-mask',
+                              help='rotación de la máscara contra '
+                                   'segmentar de nuevo la imagen rotada')
+    p.add_argument('images', nargs='+', help='imágenes')
+    p.add_argument('--ppm', type=int, required=True, help='pixeles por metro')
+    p.add_argument('-m', '--model', required=True, help='fichero del modelo')
+    p.set_defaults(fun=bench_rotate_mask)
+
+    p = subparsers.add_parser('orientation',
+                              help='métodos de orientación de las hileras')
+    p.add_argument('--size', type=int, default=4000,
+                   help='lado de los campos sintéticos en pixeles')
+    p.add_argument('--ppm', type=int, default=200, help='pixeles por metro')
+    p.add_argument('--fields', type=int, default=10,
+                   help='cantidad de campos por densidad')
+    p.add_argument('--density', type=float, nargs='+', default=[1.,0.3,0.1],
+                   help='fracciones de plantas presentes')
+    p.add_argument('--seed', type=int, default=0, help='semilla')
+    p.set_defaults(fun=bench_orientation)
+
+    p = subparsers.add_parser('autocorrelation',
+                              help='orientación por auto-correlación '
+                                   '(prueba contra la anterior)')
+    p.add_argument('--size', type=int, nargs='+', default=[2000,4000],
+                   help='lados de los campos sintéticos en pixeles')
+    p.add_argument('--ppm', type=int, default=200, help='pixeles por metro')
+    p.add_argument('--fields', type=int, default=5,
+                   help='cantidad de campos por tamaño')
+    p.add_argument('--lags', type=float, default=0.25,
+                   help='fracción de desplazamientos de la ventana reducida')
+    p.add_argument('--tol', type=float, default=0.01,
+                   help='diferencia máxima admitida en grados sin '
+                        'argumentos (por defecto: %(default)s)')
+    p.add_argument('--seed', type=int, default=0, help='semilla')
+    p.set_defaults(fun=bench_autocorrelation)
+
+    p = subparsers.add_parser('rows-detection',
+                              help='asignación de los objetos a las hileras')
+    p.add_argument('--size', type=int, nargs='+', default=[2000,5000,14000],
+                   help='lados de los campos sintéticos en pixeles')
+    p.add_argument('--ppm', type=int, default=100, help='pixeles por metro')
+    p.add_argument('--legacy', action='store_true',
+                   help='ejecuta también la implementación anterior (muy '
+                        'lenta en los campos grandes)')
+    p.set_defaults(fun=bench_rows_detection)
+
+    p = subparsers.add_parser('uncontained',
+                              help='eliminación de los objetos contenidos '
+                                   'en x (prueba contra la anterior)')
+    p.add_argument('--sets', type=int, default=3000,
+                   help='cantidad de conjuntos de intervalos')
+    p.add_argument('--max-n', type=int, default=60,
+                   help='cantidad máxima de intervalos por conjunto')
+    p.add_argument('--seed', type=int, default=0, help='semilla')
+    p.set_defaults(fun=bench_uncontained)
+
+    p = subparsers.add_parser('strips',
+                              help='detección de hileras curvas por franjas')
+    p.add_argument('--size', type=int, default=6000,
+                   help='lado de los campos sintéticos en pixeles')
+    p.add_argument('--ppm', type=int, default=100, help='pixeles por metro')
+    p.add_argument('--bend', type=float, nargs='+', default=[0,0.2,0.5,1,2],
+                   help='curvaturas (desplazamiento en los extremos en m)')
+    p.add_argument('--strip', type=int, default=1000,
+                   help='ancho de las franjas en pixeles')
+    p.add_argument('--threads', type=int, default=4, help='cantidad de hilos')
+    p.set_defaults(fun=bench_strips)
+
+    p = subparsers.add_parser('packed-mask',
+                              help='máscara empaquetada por bits')
+    p.add_argument('--size', type=int, nargs='+', default=[2000,6000,12000],
+                   help='lados de los campos sintéticos en pixeles')
+    p.add_argument('--ppm', type=int, default=100, help='pixeles por metro')
+    p.set_defaults(fun=bench_packed_mask)
+
+    p = subparsers.add_parser('descriptors',
+                              help='cálculo vectorizado de los descriptores')
+    p.add_argument('masks', nargs='+',
+                   help='máscaras o lados de campos sintéticos en pixeles')
+    p.add_argument('--ppm', type=int, default=100, help='pixeles por metro')
+    p.add_argument('--threads', type=int, nargs='*', default=[2,4,8],
+                   help='cantidades de hilos y de procesos a comparar')
+    p.add_argument('--tol', type=float, default=1e-6,
+                   help='error relativo máximo admitido (por defecto: '
+                        '%(default)s)')
+    p.set_defaults(fun=bench_descriptors)
+
+    p = subparsers.add_parser('descriptors-io',
+                              help='carga de ficheros de descriptores')
+    p.add_argument('--files', type=int, default=200,
+                   help='cantidad de ficheros')
+    p.add_argument('--rows', type=int, default=5000,
+                   help='filas por fichero')
+    p.set_defaults(fun=bench_descriptors_io)
+
+    p = subparsers.add_parser('train', help='entrenamiento por bloques')
+    p.add_argument('--files', type=int, default=50,
+                   help='cantidad de ficheros')
+    p.add_argument('--rows', type=int, default=100000,
+                   help='filas por fichero')
+    p.set_defaults(fun=bench_train)
+
+    p = subparsers.add_parser('imports', help='tiempo de importación')
+    p.add_argument('modules', nargs='*',
+                   default=['counting', 'batch', 'tiling', 'descriptors',
+                            'model', 'counting_file', 'model_selection',
+                            'main'],
+                   help='módulos a importar')
+    p.add_argument('--repeat', type=int, default=3,
+                   help='repeticiones (se informa la mejor)')
+    p.set_defaults(fun=bench_imports)
+
+    args = parser.parse_args(argv)
+    args.fun(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Created on Mon Oct  5 04:53:31 2026
+# @author: Fernando Camussi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" Tabla de objetos (blobs) de una máscara
+
+Los contornos se extraen una sola vez y se guardan concatenados en un único
+array de puntos con los desplazamientos donde empieza cada uno. El resto de
+los datos de cada objeto (etiqueta, área, momentos, bounding box, centroide
+e hilera) son columnas de arrays de NumPy, calculadas de forma vectorizada.
+"""
+
+import cv2 as cv
+import numpy as np
+
+
+class Blobs():
+
+    """ Tabla de objetos con sus contornos y datos """
+
+    def __init__(self, points, offsets, label=None, row=None):
+        """ Argumentos:
+            points -- array de Mx2 (int32) con los puntos de todos los
+                      contornos concatenados
+            offsets -- array de N+1 con la posición en points donde empieza
+                       cada contorno (el último es M)
+            label -- identificadores de los objetos (por defecto 1..N)
+            row -- hilera a la que pertenece cada objeto (por defecto -1,
+                   sin hilera)
+        """
+        self.points = points
+        self.offsets = offsets
+        n = len(offsets) - 1
+        self.label = (np.arange(1, n+1, dtype=np.int32) if label is None
+                      else label)
+        self.row = np.full(n, -1, np.int32) if row is None else row
+        self.__compute()
+
+    def fromContours(contours):
+        """ Crea la tabla a partir de una lista de contornos de OpenCV """
+        lengths = [len(cnt) for cnt in contours]
+        offsets = np.zeros(len(contours)+1, np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        if len(contours) > 0:
+            points = np.concatenate(contours).reshape(-1, 2)
+        else:
+            points = np.zeros((0,2), np.int32)
+        return Blobs(points.astype(np.int32, copy=False), offsets)
+
+    def fromMask(mask):
+        """ Crea la tabla con los contornos externos de los objetos de la
+        máscara (en el mismo orden que cv.findContours)
+        """
+        contours,_ = cv.findContours(mask, cv.RETR_EXTERNAL,
+                                     cv.CHAIN_APPROX_NONE)
+        return Blobs.fromContours(contours)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def contour(self, i):
+        """ Retorna el contorno del objeto i en formato de OpenCV (una vista
+        de points, sin copiar)
+        """
+        return self.points[self.offsets[i]:self.offsets[i+1]].reshape(-1, 1,
+                                                                       2)
+
+    def contours(self):
+        """ Retorna la lista de contornos en formato de OpenCV """
+        return [self.contour(i) for i in range(len(self))]
+
+    def take(self, idx):
+        """ Retorna una nueva tabla con los objetos de los índices dados (o
+        de una máscara booleana), en ese orden. Se conservan las etiquetas y
+        las hileras. Con un slice de paso 1 la tabla comparte los arrays
+        con esta y no se recalculan los momentos
+        """
+        if isinstance(idx, slice) and idx.step in (None,1):
+            i0,i1,_ = idx.indices(len(self))
+            i1 = max(i0, i1)
+            o0 = self.offsets[i0]
+            blobs = Blobs.__new__(Blobs)
+            blobs.points = self.points[o0:self.offsets[i1]]
+            blobs.offsets = self.offsets[i0:i1+1] - o0
+            for name in ('label', 'row', 'bbox', 'moments',
+                         'central_moments', 'area', 'centroid'):
+                setattr(blobs, name, getattr(self, name)[i0:i1])
+            return blobs
+        idx = np.arange(len(self))[idx]
+        lengths = np.diff(self.offsets)[idx]
+        offsets = np.zeros(len(idx)+1, np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        gather = (np.repeat(self.offsets[idx] - offsets[:-1], lengths) +
+                  np.arange(offsets[-1]))
+        return Blobs(self.points[gather], offsets, self.label[idx],
+                     self.row[idx])
+
+    def labelImage(self, shape):
+        """ Retorna una imagen de etiquetas (int32) donde los pixeles de cada
+        objeto tienen su etiqueta y el resto 0. Se etiquetan las componentes
+        conexas de los contornos rellenados y cada componente se identifica
+        por el primer punto de su contorno, que es su primer pixel en orden
+        de barrido
+
+        Argumentos:
+            shape -- dimensiones de la imagen
+        """
+        mask = np.zeros(shape[:2], np.uint8)
+        cv.drawContours(mask, self.contours(), -1, 255, cv.FILLED)
+        n,labels = cv.connectedComponents(mask, connectivity=8,
+                                          ltype=cv.CV_32S)
+        lut = np.zeros(n, np.int32)
+        first = self.points[self.offsets[:-1]]
+        lut[labels[first[:,1],first[:,0]]] = self.label
+        lut[0] = 0
+        np.take(lut, labels, out=labels)
+        return labels
+
+    def __compute(self):
+        # Momentos del polígono de cada contorno con las mismas fórmulas que
+        # cv.moments. Los de orden 0 y 1 se acumulan en enteros de 64 bits,
+        # por lo que coinciden exactamente con los de OpenCV (que suma en
+        # doble precisión valores enteros). Los de orden 2 se calculan
+        # centrados en la esquina del bounding box para no perder precisión
+        n = len(self)
+        if n == 0:
+            self.bbox = np.zeros((0,4), np.int32)
+            self.moments = np.zeros((0,3))
+            self.central_moments = np.zeros((0,3))
+            self.area = np.zeros(0)
+            self.centroid = np.zeros((0,2))
+            return
+        starts = self.offsets[:-1]
+        lengths = np.diff(self.offsets)
+        x = self.points[:,0].astype(np.int64)
+        y = self.points[:,1].astype(np.int64)
+
+        # Bounding box (como cv.boundingRect)
+        x0 = np.minimum.reduceat(x, starts)
+        y0 = np.minimum.reduceat(y, starts)
+        x1 = np.maximum.reduceat(x, starts)
+        y1 = np.maximum.reduceat(y, starts)
+        self.bbox = np.column_stack((x0, y0, x1-x0+1, y1-y0+1)).astype(
+            np.int32)
+
+        # Punto anterior de cada punto dentro de su contorno (cerrado)
+        prev = np.arange(-1, len(x)-1)
+        prev[starts] = self.offsets[1:] - 1
+        xp = x[prev]
+        yp = y[prev]
+        dxy = xp*y - x*yp
+        a00 = np.add.reduceat(dxy, starts)
+        a10 = np.add.reduceat(dxy*(xp+x), starts)
+        a01 = np.add.reduceat(dxy*(yp+y), starts)
+        sign = np.sign(a00)
+        m00 = (sign*a00) * 0.5
+        m10 = (sign*a10) * (1./6)
+        m01 = (sign*a01) * (1./6)
+        self.moments = np.column_stack((m00, m10, m01))
+        self.area = m00
+
+        # Momentos centrales de orden 2
+        ox = np.repeat(x0, lengths)
+        oy = np.repeat(y0, lengths)
+        x -= ox
+        y -= oy
+        xp -= ox
+        yp -= oy
+        dxy = xp*y - x*yp
+        a10 = np.add.reduceat(dxy*(xp+x), starts)
+        a01 = np.add.reduceat(dxy*(yp+y), starts)
+        a20 = np.add.reduceat(dxy*(xp*(xp+x) + x*x), starts)
+        a11 = np.add.reduceat(dxy*(xp*(2*yp+y) + x*(yp+2*y)), starts)
+        a02 = np.add.reduceat(dxy*(yp*(yp+y) + y*y), starts)
+        nz = m00 > 0
+        m00_ = np.where(nz, m00, 1)
+        cx = sign*a10 / 6 / m00_
+        cy = sign*a01 / 6 / m00_
+        self.central_moments = np.where(
+            nz[:,None],
+            np.column_stack((sign*a20/12 - cx*cx*m00, sign*a11/24 - cx*cy*m00,
+                             sign*a02/12 - cy*cy*m00)), 0)
+
+        # Centroide. En los contornos degenerados (área nula) se usa el
+        # promedio de sus puntos
+        self.centroid = np.column_stack((
+            np.where(nz, m10/m00_,
+                     np.add.reduceat(x + ox, starts)/lengths),
+            np.where(nz, m01/m00_,
+                     np.add.reduceat(y + oy, starts)/lengths)))
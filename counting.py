@@ -22,26 +22,33 @@
 from rows_detection import rows_detection
 from descriptors import Descriptors
 from model import Model
-import cv2 as cv
+import numpy as np
 
 
-def counting(mask, model_file, ppm):
+def counting(mask, model_file, ppm, strip=None, threads=None):
     """ Aplica el modelo para predecir la cantidad de plantas que hay en
         la máscara
 
     Argumentos:
         mask -- máscara
         model_file -- nombre del fichero del modelo
+        ppm -- pixeles por metro
+        strip -- ancho de las franjas para detectar hileras curvas (ver
+                 rows_detection)
+        threads -- cantidad de hilos para las franjas y los descriptores
 
     Retorna: total de plantas, lista de rectángulos con la cantidad de plantas
         que hay en el mismo, total de hileras, y lineas de las hileras
     """
 
-    model = Model.load(model_file)
-    contours,total_rows,lines = rows_detection(mask, ppm)
-    if len(contours) > 0:
-        n_plants = Model.apply(model, Descriptors.compute(contours, ppm))
-        total_plants = round(sum(n_plants))
-        rects = [(cv.boundingRect(cnt),'%.1f' % n_plants[j])
-                    for j,cnt in enumerate(contours) if n_plants[j] > 0]
+    model = Model.cached(model_file)
+    blobs,total_rows,lines = rows_detection(mask, ppm, strip, threads)
+    total_plants = 0
+    rects = []
+    if len(blobs) > 0:
+        n_plants = Model.apply(model, Descriptors.array(blobs, ppm,
+                                                     threads=threads))
+        total_plants = round(float(n_plants.sum(dtype=np.float64)))
+        rects = [(tuple(blobs.bbox[j].tolist()),'%.1f' % n_plants[j])
+                    for j in range(len(blobs)) if n_plants[j] > 0]
     return (total_plants,rects,total_rows,lines)
@@ -17,12 +17,35 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-""" Fichero de conteo """
+""" Fichero de conteo
 
-import cv2 as cv
+El fichero de conteo es un único zip que contiene:
+    manifest.json -- versión del formato, pixeles por metro, dimensiones de
+                     la imagen y de la máscara, lado de las teselas y
+                     resultados del último conteo
+    points.npy -- array de Nx2 (int32) con las coordenadas de las plantas
+    mask.npy -- máscara empaquetada por bits (ver PackedMask)
+    image/<fila>_<columna>.png -- teselas de la imagen
+Al abrirlo se leen solo el manifiesto y los puntos; la máscara y las teselas
+de la imagen se decodifican recién cuando se piden. Los ficheros en el
+formato anterior (un fichero de texto con los nombres de la imagen y de la
+máscara, ppm y los puntos) se siguen pudiendo abrir y al guardarlos se
+convierten al nuevo formato. En memoria la máscara también se mantiene
+empaquetada.
+
+No depende de Qt: los puntos se guardan como pares (x,y) y la conversión a
+los tipos de Qt se hace en la interfaz gráfica.
+"""
+
+from packed_mask import PackedMask
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import os
 import os.path
-from PyQt5.QtCore import QPoint
-from PyQt5.QtGui import QImage, QPixmap
+import zipfile
+import cv2 as cv
+import numpy as np
 
 
 class CountingFile():
@@ -30,28 +53,55 @@ class CountingFile():
     """ Carga y guarda la información relacionada con el conteo """
 
     def __init__(self, file=None):
+        self.file = None
+        self.image = None
+        self.mask = None
+        self.ppm = None
         self.points = []
+        self.results = None
+        # Origen de la imagen y de la máscara que todavía no se leyeron:
+        # el contenedor (con las dimensiones y el lado de las teselas) o los
+        # ficheros del formato anterior
+        self.__container = None
+        self.__shape = None
+        self.__tile = None
+        self.__mask_shape = None
+        self.__version = None
+        # Si la imagen se reemplazó con setImage ya no se copian las teselas
+        # del contenedor
+        self.__image_changed = False
+        self.imageFile = None
+        self.maskFile = None
         if file is None:
-            self.file = None
-            self.imageFile = None
-            self.imageMask = None
-            self.image = None
-            self.mask = None
-            self.ppm = None
+            return
+        self.file = file
+        if zipfile.is_zipfile(file):
+            with zipfile.ZipFile(file) as z:
+                manifest = json.loads(z.read('manifest.json'))
+                if manifest.get('version', 0) > __class__.FORMAT_VERSION:
+                    raise ValueError('Formato de fichero de conteo no '
+                                     'soportado: %s' % file)
+                points = np.load(io.BytesIO(z.read('points.npy')),
+                                 allow_pickle=False)
+            self.ppm = manifest['ppm']
+            self.results = manifest.get('results')
+            self.points = [tuple(p) for p in points.tolist()]
+            self.__container = file
+            self.__shape = tuple(manifest['shape'])
+            self.__tile = manifest['tile']
+            self.__mask_shape = manifest.get('mask_shape')
+            self.__version = manifest.get('version', 1)
         else:
-            self.file = file
             f = open(self.file, 'r')
             imageFile = f.readline().rstrip()
             maskFile = f.readline().rstrip()
             ppm = int(f.readline().rstrip())
             self.imageFile = os.path.dirname(self.file) + '/' +  imageFile
             self.maskFile = os.path.dirname(self.file) + '/' +  maskFile
-            self.image = cv.imread(self.imageFile, cv.IMREAD_COLOR)
-            self.mask = cv.imread(self.maskFile, cv.IMREAD_GRAYSCALE)
             self.ppm = ppm
             for l in f:
-                p = list(map(int, l.split(',')))
-                self.points.append(QPoint(p[0],p[1]))
+                x,y = map(int, l.split(','))
+                self.points.append((x,y))
             f.close()
 
     def getFile(self):
@@ -61,32 +111,100 @@ class CountingFile():
 
     def getImage(self):
 
-        """ Retorna la imagen """
+        """ Retorna la imagen (se decodifica la primera vez que se pide) """
+        if self.image is None:
+            if self.__container is not None:
+                self.image = self.getImageRegion(0, self.__shape[0], 0,
+                                                 self.__shape[1])
+            elif self.imageFile is not None:
+                self.image = cv.imread(self.imageFile, cv.IMREAD_COLOR)
         return self.image
 
+    def getImageRegion(self, y0, y1, x0, x1):
+
+        """ Retorna la región [y0:y1,x0:x1] de la imagen. Si la imagen todavía
+        no se leyó, se decodifican solo las teselas que la cubren
+        """
+        if self.image is not None or self.__container is None:
+            return self.getImage()[y0:y1,x0:x1].copy()
+        [h,w] = self.__shape[:2]
+        t = self.__tile
+        y0,y1 = max(y0, 0),min(y1, h)
+        x0,x1 = max(x0, 0),min(x1, w)
+        region = np.zeros((max(y1-y0, 0),max(x1-x0, 0)) + self.__shape[2:],
+                          np.uint8)
+        keys = [(i,j) for i in range(y0 // t, (y1-1) // t + 1)
+                      for j in range(x0 // t, (x1-1) // t + 1)]
+        if region.size == 0:
+            keys = []
+        with zipfile.ZipFile(self.__container) as z:
+            data = [z.read(__class__.__tileName(i, j)) for i,j in keys]
+        with ThreadPoolExecutor() as executor:
+            tiles = executor.map(__class__.__decode, data)
+            for (i,j),tile in zip(keys, tiles):
+                # Intersección de la tesela con la región
+                ty0,tx0 = i*t,j*t
+                a0,a1 = max(y0, ty0),min(y1, ty0+t)
+                b0,b1 = max(x0, tx0),min(x1, tx0+t)
+                region[a0-y0:a1-y0,b0-x0:b1-x0] = \
+                    tile[a0-ty0:a1-ty0,b0-tx0:b1-tx0]
+        return region
+
     def setImage(self, image):
 
         """ Fija la imagen """
         self.image = image
+        self.__image_changed = True
 
     def getMask(self):
 
-        """ Retorna la máscara """
+        """ Retorna la máscara como array (0 y 255) """
+        mask = self.getPackedMask()
+        return None if mask is None else mask.toDense()
+
+    def getPackedMask(self):
+
+        """ Retorna la máscara empaquetada (se lee la primera vez que se
+        pide)
+        """
+        if self.mask is None:
+            if self.__version == 1:
+                # Versión 1 del formato: máscara en PNG
+                with zipfile.ZipFile(self.__container) as z:
+                    self.mask = PackedMask.fromDense(
+                        __class__.__decode(z.read('mask.png')))
+            elif self.__container is not None:
+                # Sin mask_shape el fichero no tiene máscara
+                if self.__mask_shape is not None:
+                    with zipfile.ZipFile(self.__container) as z:
+                        bits = np.load(io.BytesIO(z.read('mask.npy')),
+                                       allow_pickle=False)
+                    self.mask = PackedMask(bits, self.__mask_shape[1])
+            elif self.maskFile is not None:
+                self.mask = PackedMask.fromDense(
+                    cv.imread(self.maskFile, cv.IMREAD_GRAYSCALE))
         return self.mask
 
     def setMask(self, mask):
 
-        """ Fija la máscara """
+        """ Fija la máscara (array o PackedMask). Se descartan los
+        resultados guardados
+        """
+        if mask is not None and not isinstance(mask, PackedMask):
+            mask = PackedMask.fromDense(mask)
         self.mask = mask
+        self.results = None
 
     def getPoints(self):
 
-        """ Retorna una lista con los puntos de coordenadas de las plantas """
+        """ Retorna una lista con los pares (x,y) de coordenadas de las
+        plantas
+        """
         return self.points
 
     def setPoints(self, points):
 
-        """ Fija la lista de puntos de coordenadas de las plantas """
+        """ Fija la lista de pares (x,y) de coordenadas de las plantas """
         self.points = points
 
     def getPPM(self):
@@ -96,36 +214,79 @@ class CountingFile():
 
     def setPPM(self, ppm):
 
-        """ Fija pixeles por metro """
+        """ Fija pixeles por metro. Se descartan los resultados guardados """
         self.ppm = ppm
+        self.results = None
+
+    def getResults(self):
+
+        """ Retorna los resultados del último conteo guardados en el fichero
+        (diccionario con model, total_plants, rects, total_rows y lines) o
+        None si no hay
+        """
+        return self.results
+
+    def setResults(self, results):
+
+        """ Fija los resultados del último conteo """
+        self.results = results
 
     def saveFile(self, file):
 
-        """ Guarda los puntos, la máscara y la imagen
+        """ Guarda los puntos, la máscara, la imagen y los resultados en un
+        único fichero. Si la imagen no se reemplazó, sus teselas se copian
+        del fichero original sin volver a codificarlas
         """
+        copy = not self.__image_changed and self.__container is not None
+        if copy:
+            shape,tile = self.__shape,self.__tile
+        else:
+            image = self.getImage()
+            shape,tile = image.shape,__class__.TILE
+        mask = self.getPackedMask()
+        manifest = dict(version=__class__.FORMAT_VERSION, ppm=self.ppm,
+                        shape=list(shape), tile=tile,
+                        mask_shape=None if mask is None else list(mask.shape),
+                        results=self.results)
+        keys = [(i,j) for i in range(-(-shape[0] // tile))
+                      for j in range(-(-shape[1] // tile))]
+
+        # Se escribe en un fichero temporal porque el destino puede ser el
+        # mismo contenedor del que se copian las teselas
+        tmp_file = file + '.tmp'
+        # Solo se comprimen el manifiesto, los puntos y la máscara, las
+        # teselas ya están comprimidas
+        with zipfile.ZipFile(tmp_file, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('manifest.json',
+                       json.dumps(manifest, default=lambda o: o.item()))
+            points = np.array(self.points, np.int32).reshape(-1, 2)
+            with z.open('points.npy', 'w') as f:
+                np.save(f, points)
+            if mask is not None:
+                with z.open('mask.npy', 'w') as f:
+                    np.save(f, mask.bits)
+            if copy:
+                with zipfile.ZipFile(self.__container) as src:
+                    for i,j in keys:
+                        name = __class__.__tileName(i, j)
+                        z.writestr(name, src.read(name), zipfile.ZIP_STORED)
+            else:
+                tiles = (image[i*tile:(i+1)*tile,j*tile:(j+1)*tile]
+                         for i,j in keys)
+                with ThreadPoolExecutor() as executor:
+                    for (i,j),data in zip(keys, executor.map(
+                            __class__.__encode, tiles)):
+                        z.writestr(__class__.__tileName(i, j), data,
+                                   zipfile.ZIP_STORED)
+        os.replace(tmp_file, file)
+
         self.file = file
-        f = open(self.file, 'w')
-        if self.imageFile is None:
-            self.imageFile = os.path.splitext(self.file)[0] + '.image.tif'
-            self.maskFile = os.path.splitext(self.file)[0] + '.mask.tif'
-            cv.imwrite(self.imageFile, self.image)
-            cv.imwrite(self.maskFile, self.mask)
-        f.write(os.path.basename(self.imageFile) + '\n')
-        f.write(os.path.basename(self.maskFile) + '\n')
-        f.write(str(self.ppm) + '\n')
-        for p in self.points:
-            f.write(str(p.x()) + ',' + str(p.y()) + '\n')
-        f.close()
-
-    def cvImageToQPixmap(cv_image):
-
-        """ Convierte una imagen en formato OpenCV a una imagen en formato
-            QPixmap
-        """
-        cv_image = cv.cvtColor(cv_image, cv.COLOR_BGR2RGB)
-        [h,w,_] = cv_image.shape
-        image = QImage(cv_image.data, w, h, w*3, QImage.Format_RGB888)
-        return QPixmap(image)
+        self.__container = file
+        self.__shape = tuple(shape)
+        self.__tile = tile
+        self.__image_changed = False
+        self.__mask_shape = None if mask is None else list(mask.shape)
+        self.__version = __class__.FORMAT_VERSION
 
     def isRGB(cv_image):
 
@@ -136,3 +297,22 @@ class CountingFile():
         channel_B = cv_image[:,:,0]
         return not ((channel_R == channel_G).all() and \
                     (channel_G == channel_B).all())
+
+    def __tileName(i, j):
+        return 'image/%d_%d.png' % (i, j)
+
+    def __encode(image):
+        # PNG sin pérdida
+        ok,data = cv.imencode('.png', image)
+        if not ok:
+            raise ValueError('No se pudo codificar la imagen.')
+        return data.tobytes()
+
+    def __decode(data):
+        return cv.imdecode(np.frombuffer(data, np.uint8), cv.IMREAD_UNCHANGED)
+
+    # Versión del formato del fichero de conteo
+    FORMAT_VERSION = 2
+
+    # Lado de las teselas de la imagen en pixeles
+    TILE = 1024
@@ -19,69 +19,264 @@
 
 """ Descriptores """
 
+from blobs import Blobs
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import os
 import cv2 as cv
 import numpy as np
-import pandas as pd
-import math
 
 
 class Descriptors():
 
     """ Clase no instanciable """
 
-    def compute(contours, ppm, points=None):
-        """ Calcula los descriptores para cada contorno
+    def compute(blobs, ppm, points=None, threads=None):
+        """ Calcula los descriptores para cada objeto
 
         Argumentos:
-            contours -- lista de contornos
-            points -- puntos con las coordenadas de las plantas
+            blobs -- tabla de objetos (Blobs)
+            points -- pares (x,y) con las coordenadas de las plantas
 
-            si puntos es None se calcula para todos los contornos, sino se
-            calcula para los contornos donde hay algún punto y se agrega la
+            si puntos es None se calcula para todos los objetos, sino se
+            calcula para los objetos donde hay algún punto y se agrega la
             cantidad de puntos como última columna
 
+            threads -- cantidad de hilos (ver array)
+
         Retorna: dataframe con los datos
         """
-        descr_list = []
+        # pandas se importa al usarlo para no demorar el arranque
+        import pandas as pd
         if points is None:
-            for cnt in contours:
-                descr_vector = __class__.__vector(cnt, ppm)
-                descr_list.append(descr_vector)
-            df = pd.DataFrame(descr_list, columns = __class__.__header[:-1])
+            df = pd.DataFrame(__class__.array(blobs, ppm, np.float64,
+                                              threads),
+                              columns = __class__.__header[:-1])
         else:
-            n_plants = lambda cnt: sum(map(lambda p:
-                                           cv.pointPolygonTest(
-                                               cnt, (p.x(),p.y()), False) >= 0,
-                                           points))
-            for i,cnt in enumerate(contours):
-                n = n_plants(cnt)
-                if n > 0:
-                    descr_vector = __class__.__vector(cnt, ppm)
-                    descr_vector.append(n)
-                    descr_list.append(descr_vector)
-            df = pd.DataFrame(descr_list, columns = __class__.__header)
+            n = __class__.__count_points(blobs, points)
+            idx = np.flatnonzero(n > 0)
+            df = pd.DataFrame(__class__.array(blobs.take(idx), ppm,
+                                              np.float64, threads),
+                              columns = __class__.__header[:-1])
+            df[__class__.__header[-1]] = n[idx]
         return df
 
-    def load(descr_files):
-        """ Carga descriptores a partir de varios ficheros omitiendo la primer
-        fila de cada uno (encabezados)
+    def array(blobs, ppm, dtype=np.float32, threads=None, processes=None):
+        """ Calcula los descriptores de todos los objetos a la vez
+
+        Argumentos:
+            blobs -- tabla de objetos (Blobs)
+            ppm -- pixeles por metro
+            dtype -- tipo de datos del resultado
+            threads -- cantidad de hilos. Los objetos se dividen en bloques
+                       consecutivos que se calculan en paralelo; el orden de
+                       las filas no cambia. La envolvente convexa se calcula
+                       objeto por objeto con el GIL tomado (dos tercios del
+                       tiempo), por lo que no escala a más de unas 1,5 veces
+            processes -- cantidad de procesos. Los contornos se copian una
+                         vez a memoria compartida y cada proceso calcula
+                         bloques de objetos (ver block). Escala con los
+                         núcleos, pero iniciar los procesos tiene un costo
+                         fijo y solo conviene con muchos objetos. Si se
+                         indica, threads no se usa
+
+        Retorna: array de Nx10 con los descriptores, en el orden de las
+                 columnas de compute
+        """
+        n = len(blobs)
+        if n == 0:
+            return np.zeros((0,len(__class__.__header)-1), dtype)
+        workers = processes if processes is not None else threads
+        if workers is None or workers <= 1 or n < 2*__class__.__CHUNK:
+            return __class__.__array(blobs, ppm).astype(dtype, copy=False)
+        # Bloques de al menos __CHUNK objetos, varios por hilo o proceso para
+        # repartir mejor la carga
+        n_chunks = min(4*workers, n // __class__.__CHUNK)
+        bounds = np.linspace(0, n, n_chunks+1).astype(int)
+        descr = np.empty((n,len(__class__.__header)-1), dtype)
+        if processes is not None:
+            points = blobs.points.astype(np.int32, copy=False)
+            offsets = blobs.offsets.astype(np.int64, copy=False)
+            shm = SharedMemory(create=True,
+                               size=offsets.nbytes + points.nbytes)
+            try:
+                np.ndarray(offsets.shape, np.int64, shm.buf)[:] = offsets
+                np.ndarray(points.shape, np.int32, shm.buf,
+                           offsets.nbytes)[:] = points
+                args = [(shm.name,n,lo,hi,ppm)
+                        for lo,hi in zip(bounds[:-1], bounds[1:])]
+                with ProcessPoolExecutor(processes) as executor:
+                    for i,d in enumerate(executor.map(__class__.block,
+                                                      *zip(*args))):
+                        descr[bounds[i]:bounds[i+1]] = d
+            finally:
+                shm.close()
+                shm.unlink()
+        else:
+            fun = lambda i: __class__.__array(
+                blobs.take(slice(bounds[i], bounds[i+1])), ppm)
+            with ThreadPoolExecutor(threads) as executor:
+                for i,d in enumerate(executor.map(fun, range(n_chunks))):
+                    descr[bounds[i]:bounds[i+1]] = d
+        return descr
+
+    def block(shm_name, n, lo, hi, ppm):
+        """ Calcula los descriptores de los objetos lo a hi-1 de una tabla
+        guardada en memoria compartida (se ejecuta en los procesos de array)
+
+        Argumentos:
+            shm_name -- nombre de la memoria compartida, con los N+1
+                        offsets (int64) seguidos de los puntos (int32)
+            n -- cantidad de objetos de la tabla
+            lo, hi -- rango de objetos a calcular
+            ppm -- pixeles por metro
+
+        Retorna: array con los descriptores en float64
+        """
+        # Se copia solo el bloque, para poder cerrar la memoria compartida
+        shm = SharedMemory(shm_name)
+        offsets = np.ndarray(n+1, np.int64, shm.buf)
+        o0,o1 = offsets[lo],offsets[hi]
+        points = np.ndarray((o1-o0,2), np.int32, shm.buf, 8*(n+1) + 8*o0)
+        blobs = Blobs(points.copy(), offsets[lo:hi+1] - o0)
+        del offsets,points
+        shm.close()
+        return __class__.__array(blobs, ppm)
+
+    def __array(blobs, ppm):
+        # Descriptores en float64 de una tabla de objetos no vacía
+        w = blobs.bbox[:,2].astype(np.float64)
+        h = blobs.bbox[:,3].astype(np.float64)
+        bb_area = w*h
+        area = blobs.area
+        perimeter = __class__.__perimeter(blobs.points, blobs.offsets)
+        hulls = Blobs.fromContours([cv.convexHull(cnt)
+                                    for cnt in blobs.contours()])
+        hull_area = hulls.area
+        hull_perimeter = __class__.__perimeter(hulls.points, hulls.offsets)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            descr = np.column_stack((
+                # 1 - Área en m^2
+                area / ppm**2,
+                # 2 - Área del bounding box en m^2
+                bb_area / ppm**2,
+                # 3 - Perímetro en m
+                perimeter / ppm,
+                # 4 - Perímetro del bounding box en m
+                (2*w+2*h) / ppm,
+                # 5 - Compacidad
+                perimeter**2 / area,
+                # 6 - Excentricidad
+                __class__.__eccentricity(blobs),
+                # 7 - Relación de aspecto del bounding box
+                w/h,
+                # 8 - Extent
+                area / bb_area,
+                # 9 - Convexidad
+                hull_perimeter / perimeter,
+                # 10 - Solidez
+                area / hull_area))
+        return descr
+
+    def load(descr_files, threads=None):
+        """ Carga descriptores a partir de varios ficheros, en formato
+        binario (.npz, ver save) o CSV con encabezados. Los ficheros se leen
+        en paralelo y las columnas se copian directamente en un único array
 
         Argumentos:
             descr_files -- lista de nombres de ficheros de descriptores
+            threads -- cantidad de hilos de lectura (None: uno por fichero
+                       hasta la cantidad de CPUs)
 
-        Retorna: array con los datos
+        Retorna: dataframe con los datos
         """
-        df = pd.concat(map(pd.read_csv, descr_files))
-        return df
+        if threads is None:
+            threads = min(len(descr_files), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max(1, threads)) as executor:
+            parts = list(executor.map(__class__.__read, descr_files))
+        columns = parts[0][0] if parts else []
+        for (c,_),descr_file in zip(parts, descr_files):
+            if c != columns:
+                raise ValueError('Las columnas de %s no coinciden con las '
+                                 'del resto de los ficheros.' % descr_file)
+        n = sum(len(cols[0]) for _,cols in parts if cols)
+        data = np.empty((n,len(columns)))
+        i = 0
+        for _,cols in parts:
+            if cols:
+                k = len(cols[0])
+                for j,col in enumerate(cols):
+                    data[i:i+k,j] = col
+                i += k
+        import pandas as pd
+        return pd.DataFrame(data, columns=columns)
+
+    def chunks(descr_files, rows=100000):
+        """ Recorre los datos de varios ficheros de descriptores por bloques,
+        sin cargarlos todos en memoria. De cada .npz se tienen en memoria
+        sus columnas y un bloque; de cada CSV, solo un bloque
+
+        Argumentos:
+            descr_files -- lista de nombres de ficheros de descriptores
+            rows -- cantidad máxima de filas de cada bloque
+
+        Retorna: generador de pares (columnas, array de datos en float64)
+        """
+        for descr_file in descr_files:
+            if descr_file.lower().endswith('.npz'):
+                # Las columnas de un .npz se leen completas, pero cada
+                # bloque se arma con sus porciones sin copiar todo el
+                # fichero a una matriz
+                columns,cols = __class__.__read(descr_file)
+                n = len(cols[0]) if cols else 0
+                for i in range(0, n, rows):
+                    yield (columns,np.column_stack(
+                        [c[i:i+rows].astype(np.float64) for c in cols]))
+            else:
+                import pandas as pd
+                for df in pd.read_csv(descr_file, chunksize=rows):
+                    yield (list(df.columns),df.to_numpy(np.float64))
 
     def save(descr_file, df):
-        """ Guarda un dataframe en un fichero
+        """ Guarda un dataframe en un fichero. Si la extensión es .npz se usa
+        el formato binario por columnas: un array por columna más la versión
+        del formato y la lista de columnas (sin objetos serializados con
+        pickle). Con cualquier otra extensión se exporta a CSV
 
         Argumentos:
-            descr_files -- nombre del fichero donde se guarda
+            descr_file -- nombre del fichero donde se guarda
+            df -- dataframe con los datos
         """
-        df.to_csv(descr_file, index = False)
+        if descr_file.lower().endswith('.npz'):
+            columns = list(df.columns)
+            np.savez(descr_file,
+                     __version__=np.array(__class__.FORMAT_VERSION),
+                     __columns__=np.array(columns, dtype=str),
+                     **{c: df[c].to_numpy() for c in columns})
+        else:
+            df.to_csv(descr_file, index = False)
+
+    def __read(descr_file):
+        # Lee un fichero de descriptores y retorna la lista de columnas y la
+        # lista de arrays de cada una
+        if not descr_file.lower().endswith('.npz'):
+            import pandas as pd
+            df = pd.read_csv(descr_file)
+            return (list(df.columns),[df[c].to_numpy() for c in df.columns])
+        with np.load(descr_file, allow_pickle=False) as f:
+            if ('__version__' not in f or
+                int(f['__version__']) > __class__.FORMAT_VERSION):
+                raise ValueError('Formato de descriptores no soportado: %s' %
+                                 descr_file)
+            columns = [str(c) for c in f['__columns__']]
+            return (columns,[f[c] for c in columns])
+
+    # Versión del formato binario de descriptores
+    FORMAT_VERSION = 1
 
+    # Cantidad mínima de objetos por bloque al calcular en paralelo
+    __CHUNK = 1024
 
     __header = ['AREA_M',
                 'AREA_BB_M',
@@ -95,51 +290,47 @@ class Descriptors():
                 'SOLIDEZ',
                 'CANTIDAD_PLANTAS']
                 
-    def __descr_eccentricity(contour):
-        z = np.matrix(contour[:,0,:])
-        K = z.shape[0]
-        z_ = np.sum(z,axis=0)/K
-        C = np.sum([np.matmul((zk-z_).T,zk-z_) for zk in z],axis=0)/(K-1)
-        eigval,_ = np.linalg.eig(C)
-        return math.sqrt(1-(min(eigval)/max(eigval))**2)       
-
-    def __vector(contour, ppm):
-        _,_,w,h = cv.boundingRect(contour)
-        bb_area = w*h
-        area = cv.contourArea(contour)
-        perimeter = cv.arcLength(contour, True)
-        hull = cv.convexHull(contour)
-        hull_area = cv.contourArea(hull)
-        hull_perimeter = cv.arcLength(hull, True)
-
-        # 1 - Área en m^2
-        area_m = area / ppm**2
-        # 2 - Área del bounding box en m^2
-        area_bb_m = bb_area / ppm**2
-        # 3 - Perímetro en m
-        perimeter_m = perimeter / ppm
-        # 4 - Perímetro del bounding box en m
-        perimeter_bb_m = (2*w+2*h) / ppm
-        # 5 - Compacidad
-        compactness = perimeter**2 / area
-        # 6 - Excentricidad
-        eccentricity = __class__.__descr_eccentricity(contour)
-        # 7 - Relación de aspecto del bounding box
-        aspect_ratio_bb = w/h
-        # 8 - Extent
-        extent = area / bb_area
-        # 9 - Convexidad
-        convexity = hull_perimeter / perimeter
-        # 10 - Solidez
-        solidity = area / hull_area
-
-        return [area_m,
-                area_bb_m,
-                perimeter_m,
-                perimeter_bb_m,
-                compactness,
-                eccentricity,
-                aspect_ratio_bb,
-                extent,
-                convexity,
-                solidity]
+    def __count_points(blobs, points):
+        # Cantidad de puntos dentro de cada objeto (incluyendo su contorno,
+        # como cv.pointPolygonTest >= 0): se busca la etiqueta de cada punto
+        # en la imagen de etiquetas y se cuentan con bincount
+        if len(blobs) == 0:
+            return np.zeros(0, int)
+        shape = ((blobs.bbox[:,1] + blobs.bbox[:,3]).max(),
+                 (blobs.bbox[:,0] + blobs.bbox[:,2]).max())
+        labels = blobs.labelImage(shape)
+        xy = np.array(points, int).reshape(-1, 2)
+        xy = xy[(xy[:,0] >= 0) & (xy[:,0] < shape[1]) &
+                (xy[:,1] >= 0) & (xy[:,1] < shape[0])]
+        hits = labels[xy[:,1],xy[:,0]]
+        return np.bincount(hits, minlength=blobs.label.max()+1)[blobs.label]
+
+    def __eccentricity(blobs):
+        # Excentricidad de la elipse dada por la matriz de covarianza de los
+        # puntos de cada contorno, a partir de sus momentos centrales de
+        # segundo orden. Las sumas se hacen en enteros con coordenadas
+        # relativas al bounding box
+        starts = blobs.offsets[:-1]
+        k = np.diff(blobs.offsets)
+        z = blobs.points - np.repeat(blobs.bbox[:,:2], k, axis=0)
+        x = z[:,0].astype(np.int64)
+        y = z[:,1].astype(np.int64)
+        sx = np.add.reduceat(x, starts)
+        sy = np.add.reduceat(y, starts)
+        cxx = np.add.reduceat(x*x, starts) - sx*sx/k
+        cxy = np.add.reduceat(x*y, starts) - sx*sy/k
+        cyy = np.add.reduceat(y*y, starts) - sy*sy/k
+        # Autovalores de la matriz simétrica [[cxx,cxy],[cxy,cyy]]
+        m = (cxx + cyy) / 2
+        d = np.hypot((cxx - cyy) / 2, cxy)
+        return np.sqrt(1 - ((m - d) / (m + d))**2)
+
+    def __perimeter(points, offsets):
+        # Perímetro de cada contorno cerrado como cv.arcLength: la longitud
+        # de cada segmento se calcula en float32 y se acumula en float64
+        starts = offsets[:-1]
+        prev = np.arange(-1, len(points)-1)
+        prev[starts] = offsets[1:] - 1
+        d = (points - points[prev]).astype(np.float32)
+        step = np.sqrt(d[:,0]*d[:,0] + d[:,1]*d[:,1])
+        return np.add.reduceat(step.astype(np.float64), starts)
@@ -23,9 +23,9 @@ from blackboard import Blackboard, Mode
 from counting_file import CountingFile
 from segmentation import segmentation
 from morphology import morphology
-from rows_orientation import rows_orientation
-from rotation import rotation
+from preprocessing import preprocessing
 from descriptors import Descriptors
+from blobs import Blobs
 from model import Model
 from counting import counting
 from PyQt5.QtWidgets import (QApplication,
@@ -42,13 +42,15 @@ from PyQt5.QtWidgets import (QApplication,
                              QMessageBox,
                              QPlainTextEdit,
                              QInputDialog)
-from PyQt5.QtGui import QFont
+from PyQt5.QtGui import QFont, QImage, QPixmap
 from PyQt5.QtCore import (Qt,
                           pyqtSignal,
                           QRunnable,
                           QThreadPool,
                           QObject,
-                          QDir)
+                          QDir,
+                          QPoint)
+import os
 import sys
 import cv2 as cv
 
@@ -79,6 +81,17 @@ def windowGeometry(window, width, height):
                        width, height)
 
 
+def cvImageToQPixmap(cv_image):
+
+    """ Convierte una imagen en formato OpenCV a una imagen en formato
+        QPixmap
+    """
+    cv_image = cv.cvtColor(cv_image, cv.COLOR_BGR2RGB)
+    [h,w,_] = cv_image.shape
+    image = QImage(cv_image.data, w, h, w*3, QImage.Format_RGB888)
+    return QPixmap(image)
+
+
 class Worker(QRunnable):
 
     class Signals(QObject):
@@ -128,26 +141,30 @@ class MainWindow(QMainWindow):
         file = getFileNameDialog(self, False, filter)
         if file:
             self.counting_file = CountingFile(file)
-            self.image = CountingFile.cvImageToQPixmap(
+            self.image = cvImageToQPixmap(
                 self.counting_file.getImage())
-            points = self.counting_file.getPoints()
+            points = [QPoint(x,y) for x,y in self.counting_file.getPoints()]
             self.blackboard.setImage(self.image)
             self.blackboard.setPoints(points)
             self.blackboard.mode = Mode.ROI
             self.initMenu()
             self.label_ppm.setText(str(self.counting_file.getPPM()))
             self.addInfoText('Se abrió el archivo %s.\n' % file)
+            results = self.counting_file.getResults()
+            if results is not None:
+                self.showResults(results)
 
     def saveFile(self):
+        points = [(p.x(),p.y()) for p in self.blackboard.getPoints()]
         if self.counting_file.getFile() is None:
             filter = 'Counting (*.counting)'
             file = getFileNameDialog(self, True, filter, 'counting')
             if file:
-                self.counting_file.setPoints(self.blackboard.getPoints())
+                self.counting_file.setPoints(points)
                 self.counting_file.saveFile(file)
                 self.addInfoText('Se creó el archivo %s.\n' % file)
         else:
-            self.counting_file.setPoints(self.blackboard.getPoints())
+            self.counting_file.setPoints(points)
             self.counting_file.saveFile(self.counting_file.getFile())
             self.addInfoText('Se guardó el archivo %s.\n' %
                                  self.counting_file.getFile())
@@ -155,15 +172,7 @@ class MainWindow(QMainWindow):
     def importImage(self):
 
         def fun(cv_image, ppm):
-            cv_mask = segmentation(cv_image)
-            cv_mask = morphology(cv_mask, ppm)
-            orientation = rows_orientation(cv_mask)
-            if orientation is None:
-                cv_image = None
-            else:
-                cv_image = rotation(cv_image, -orientation)
-                cv_mask = segmentation(cv_image)
-                cv_mask = morphology(cv_mask, ppm)
+            cv_image,cv_mask,orientation = preprocessing(cv_image, ppm)
             self.worker.signals.finished.emit((cv_image,cv_mask,
                                                orientation,ppm))
 
@@ -180,7 +189,7 @@ class MainWindow(QMainWindow):
                 self.counting_file.setImage(cv_image)
                 self.counting_file.setMask(cv_mask)
                 self.counting_file.setPPM(ppm)
-                self.image = CountingFile.cvImageToQPixmap(cv_image)
+                self.image = cvImageToQPixmap(cv_image)
                 self.blackboard.setImage(self.image)
                 self.blackboard.mode = Mode.ROI
                 self.blackboard.setPoints([])
@@ -239,7 +248,7 @@ class MainWindow(QMainWindow):
 
     def viewImage(self):
         if self.view_image_act.isChecked():
-            self.image = CountingFile.cvImageToQPixmap(
+            self.image = cvImageToQPixmap(
                 self.counting_file.getImage())
             self.blackboard.changeImage(self.image)
             self.view_mask_act.setChecked(False)
@@ -248,7 +257,7 @@ class MainWindow(QMainWindow):
 
     def viewMask(self):
         if self.view_mask_act.isChecked():
-            self.image = CountingFile.cvImageToQPixmap(
+            self.image = cvImageToQPixmap(
                 self.counting_file.getMask())
             self.blackboard.changeImage(self.image)
             self.view_image_act.setChecked(False)
@@ -259,10 +268,9 @@ class MainWindow(QMainWindow):
 
         def fun(descr_file, ppm):
             cv_mask = self.counting_file.getMask()
-            contours,_ = cv.findContours(cv_mask, cv.RETR_EXTERNAL,
-                                         cv.CHAIN_APPROX_NONE)
-            descr_df = Descriptors.compute(contours, ppm,
-                                           self.blackboard.getPoints())
+            points = [(p.x(),p.y()) for p in self.blackboard.getPoints()]
+            descr_df = Descriptors.compute(Blobs.fromMask(cv_mask), ppm,
+                                           points, os.cpu_count())
             self.worker.signals.finished.emit((descr_file,descr_df))
 
         def fun_finished(arg):
@@ -279,8 +287,8 @@ class MainWindow(QMainWindow):
             msg.exec_()
             return
 
-        filter = 'Descriptores (*.csv)'
-        descr_file = getFileNameDialog(self, True, filter, "csv")
+        filter = 'Descriptores (*.npz);;CSV (*.csv)'
+        descr_file = getFileNameDialog(self, True, filter, "npz")
         if descr_file:
             self.showProcessingMsg()
             self.worker = Worker(fun, descr_file, self.counting_file.getPPM())
@@ -295,18 +303,18 @@ class MainWindow(QMainWindow):
 
         def fun(model_file, ppm):
             mask = self.counting_file.getMask()
-            args = counting(mask, model_file, ppm)
+            args = counting(mask, model_file, ppm,
+                            threads=os.cpu_count())
             self.worker.signals.finished.emit(args)
 
         def fun_finished(args):
             total_plants,rects,total_rows,lines = args
             self.hideProcessingMsg()
-            self.blackboard.addLines(lines)
-            self.addInfoText('Se aplicó el modelo %s.' % model_file)
-            self.addInfoText('Cantidad de hileras: %d' % total_rows)
-            self.blackboard.addRectangles(rects)
-            self.addInfoText('Cantidad de grupos: %d' % len(rects))
-            self.addInfoText('Cantidad de plantas: %d\n' % total_plants)
+            results = dict(model=model_file,
+                           total_plants=total_plants, rects=rects,
+                           total_rows=total_rows, lines=lines)
+            self.counting_file.setResults(results)
+            self.showResults(results)
 
         filter = 'Imágenes (*.model)'
         model_file = getFileNameDialog(self, False, filter)
@@ -317,6 +325,15 @@ class MainWindow(QMainWindow):
             self.worker.signals.finished.connect(fun_finished)
             self.threadpool.start(self.worker)
 
+    def showResults(self, results):
+        self.blackboard.addLines(results['lines'])
+        self.addInfoText('Se aplicó el modelo %s.' % results['model'])
+        self.addInfoText('Cantidad de hileras: %d' % results['total_rows'])
+        self.blackboard.addRectangles(results['rects'])
+        self.addInfoText('Cantidad de grupos: %d' % len(results['rects']))
+        self.addInfoText('Cantidad de plantas: %d\n' %
+                             results['total_plants'])
+
     def ROIselected(self, ROI, points):
         self.ROI = ROI
         p1 = ROI.topLeft()
@@ -331,9 +348,7 @@ class MainWindow(QMainWindow):
     def ROIwindowClosed(self, points, cropped):
         if cropped:
             [x,y,w,h] = self.ROI.getRect()
-            cv_image = self.counting_file.getImage()
-            cv_mask = self.counting_file.getMask()
-            cv_image = cv_image[y:y+h,x:x+w]
+            cv_image = self.counting_file.getImageRegion(y, y+h, x, x+w)
             cv_mask = segmentation(cv_image)
             ppm = self.counting_file.getPPM()
             cv_mask = morphology(cv_mask, ppm)
@@ -342,9 +357,9 @@ class MainWindow(QMainWindow):
             self.counting_file.setMask(cv_mask)
             self.counting_file.setPPM(ppm)
             if self.view_mask_act.isChecked():
-                self.image = CountingFile.cvImageToQPixmap(cv_mask)
+                self.image = cvImageToQPixmap(cv_mask)
             else:
-                self.image = CountingFile.cvImageToQPixmap(cv_image)
+                self.image = cvImageToQPixmap(cv_image)
             self.blackboard.setImage(self.image)
             self.blackboard.setPoints([])
             self.ROI.setX(0)
@@ -548,7 +563,7 @@ class ModelWindow(QMainWindow):
         QMainWindow.showEvent(self, event)
 
     def addButtonClicked(self):
-        filter = 'CSV (*.csv)'
+        filter = 'Descriptores (*.npz *.csv)'
         descr_file = getFileNameDialog(self, False, filter)
         if descr_file:
             if not self.list_widget.findItems(descr_file,
@@ -568,9 +583,9 @@ class ModelWindow(QMainWindow):
             if file:
                 descr_files = [self.list_widget.item(row).text()
                                for row in range(self.list_widget.count())]
-                descr_list = Descriptors.load(descr_files)
-                model,info = Model.generate(descr_list)
+                model,info = Model.train(descr_files)
                 Model.save(file, model)
+                Model.invalidate(file)
                 main_window.addInfoText('Se creó el archivo de modelo %s.' %
                                             file)
                 main_window.addInfoText('R^2: %.2f\n' % info['R2'])
@@ -17,13 +17,23 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-""" Modelo """
+""" Modelo
 
+El modelo es una regresión lineal sobre los descriptores estandarizados.
+Las estandarizaciones de la entrada y de la salida se pliegan en un único
+vector de coeficientes y una ordenada, de modo que aplicarlo es un producto
+matriz-vector que solo necesita NumPy. Se guarda en un fichero .npz sin
+objetos serializados con pickle. Los modelos anteriores (pickle con el
+regresor y los escaladores de scikit-learn) no se cargan directamente, ya
+que leer un pickle puede ejecutar código arbitrario: se convierten una vez
+con Model.convert (python model.py viejo.model nuevo.model).
+"""
+
+from collections import OrderedDict
+import os
 import pickle
-from sklearn import linear_model
-from sklearn.metrics import r2_score
+import threading
 import numpy as np
-from sklearn.preprocessing import StandardScaler
 
 
 class Model():
@@ -38,51 +48,221 @@ class Model():
 
         Retorna: modelo generado e información
         """
-        data = df.values
-        X = data[:,:-1]
-        y = data[:,-1]
-        stsc_X = StandardScaler()
-        stsc_y = StandardScaler()
-        X = stsc_X.fit_transform(X)
-        y = stsc_y.fit_transform(y.reshape(-1,1)).flatten()
-        lr = linear_model.LinearRegression()
-        lr.fit(X, y)
-        y_pred = lr.predict(X)
-        r2 = r2_score(y, y_pred)
-        model = dict(lr=lr, stsc_X=stsc_X, stsc_y=stsc_y)
-        info = dict(R2=r2)
-        return (model,info)
+        return __class__.__fit([(list(df.columns),df.to_numpy(np.float64))])
+
+    def train(descr_files, rows=100000):
+        """ Genera un modelo de regresión lineal recorriendo los ficheros de
+        descriptores por bloques (ver Descriptors.chunks). La memoria no
+        crece con la cantidad de ficheros: como máximo se tienen las
+        columnas del .npz más grande (tal como están guardadas) más un
+        bloque de rows filas en float64, y con CSV solo el bloque. Da el
+        mismo modelo que generate con los datos de todos los ficheros
+
+        Argumentos:
+            descr_files -- lista de nombres de ficheros de descriptores
+            rows -- cantidad máxima de filas de cada bloque
+
+        Retorna: modelo generado e información
+        """
+        from descriptors import Descriptors
+        return __class__.__fit(Descriptors.chunks(descr_files, rows))
 
     def apply(model, df):
         """ Aplica el modelo
 
         Argumentos:
             model -- modelo a aplicar
-            df -- dataframe con los datos
+            df -- dataframe o array (ver Descriptors.array) con los datos
 
         Retorna: array con las predicciones
         """
-        X = df.values
-        X = model['stsc_X'].transform(X)
-        y = model['lr'].predict(X)
-        y = model['stsc_y'].inverse_transform(y.reshape(-1,1))[:,0]
-        return y
+        X = np.asarray(df, dtype=np.float32)
+        return X @ model['coef'].astype(np.float32) + model['intercept']
 
     def save(model_file, model):
-        """ Guarda el modelo en un fichero
+        """ Guarda el modelo en un fichero (.npz)
 
         Argumentos:
             model_file -- nombre del fichero donde se guarda
             model -- modelo a guardar
         """
-        pickle.dump(model, open(model_file, 'wb'))
+        with open(model_file, 'wb') as f:
+            np.savez(f,
+                     __version__=np.array(__class__.FORMAT_VERSION),
+                     coef=np.asarray(model['coef'], np.float64),
+                     intercept=np.array(model['intercept'], np.float64),
+                     columns=np.array(model.get('columns', []), dtype=str),
+                     R2=np.array(model.get('R2', np.nan), np.float64))
 
-    def load(model_file):
-        """ Carga un modelo desde un fichero
+    def load(model_file, allow_pickle=False):
+        """ Carga un modelo desde un fichero. Los modelos en el formato
+        anterior (pickle) solo se leen con allow_pickle, lo que requiere
+        scikit-learn; si no, se lanza un error que indica cómo convertirlos
 
         Argumentos:
             model_file -- nombre del fichero a cargar
+            allow_pickle -- permite leer modelos en el formato anterior. Solo
+                            se debe usar con ficheros de confianza
 
         Retorna: modelo cargado
         """
-        return pickle.load(open(model_file, 'rb'))
+        with open(model_file, 'rb') as f:
+            legacy = f.read(2) != b'PK'
+            f.seek(0)
+            if legacy:
+                if not allow_pickle:
+                    raise ValueError(
+                        'El modelo %s está en el formato anterior (pickle). '
+                        'Se debe convertir con: python model.py %s '
+                        'nuevo.model' % (model_file,model_file))
+                old = pickle.load(f)
+                return __class__.fold(old['lr'], old['stsc_X'],
+                                      old['stsc_y'])
+            with np.load(f, allow_pickle=False) as data:
+                if int(data['__version__']) > __class__.FORMAT_VERSION:
+                    raise ValueError('Versión del modelo no soportada: %s' %
+                                     model_file)
+                return dict(coef=data['coef'],
+                            intercept=float(data['intercept']),
+                            columns=[str(c) for c in data['columns']],
+                            R2=float(data['R2']))
+
+    def cached(model_file):
+        """ Carga un modelo a través de una caché LRU compartida por todo el
+        proceso. La clave es la ruta real del fichero junto con su fecha de
+        modificación y su tamaño, de modo que si el fichero cambia se vuelve
+        a cargar. El modelo retornado no se debe modificar
+
+        Argumentos:
+            model_file -- nombre del fichero a cargar
+
+        Retorna: modelo cargado
+        """
+        path = os.path.realpath(model_file)
+        st = os.stat(path)
+        key = (path,st.st_mtime_ns,st.st_size)
+        with __class__.__lock:
+            model = __class__.__cache.get(key)
+            if model is not None:
+                __class__.__cache.move_to_end(key)
+                return model
+        model = __class__.load(path)
+        with __class__.__lock:
+            # Se descartan las versiones anteriores del mismo fichero
+            for k in [k for k in __class__.__cache if k[0] == path]:
+                del __class__.__cache[k]
+            __class__.__cache[key] = model
+            while len(__class__.__cache) > __class__.CACHE_SIZE:
+                __class__.__cache.popitem(last=False)
+        return model
+
+    def invalidate(model_file=None):
+        """ Descarta modelos de la caché de cached
+
+        Argumentos:
+            model_file -- nombre del fichero del modelo a descartar (None:
+                          se vacía la caché)
+        """
+        with __class__.__lock:
+            if model_file is None:
+                __class__.__cache.clear()
+            else:
+                path = os.path.realpath(model_file)
+                for k in [k for k in __class__.__cache if k[0] == path]:
+                    del __class__.__cache[k]
+
+    def convert(model_file, new_model_file):
+        """ Convierte un modelo en el formato anterior (pickle) al formato
+        actual. Lee el pickle, por lo que solo se debe usar con ficheros de
+        confianza
+
+        Argumentos:
+            model_file -- nombre del fichero del modelo a convertir
+            new_model_file -- nombre del fichero donde se guarda
+        """
+        __class__.save(new_model_file,
+                       __class__.load(model_file, allow_pickle=True))
+
+    def fold(lr, stsc_X, stsc_y):
+        """ Pliega los escaladores en los coeficientes de un regresor lineal
+        de scikit-learn entrenado con los datos estandarizados:
+        y = sy*(coef·(x-mx)/sx + b) + my = x·w + b'
+
+        Argumentos:
+            lr -- regresor lineal (con coef_ e intercept_)
+            stsc_X -- StandardScaler de los descriptores
+            stsc_y -- StandardScaler de la cantidad de plantas
+
+        Retorna: modelo
+        """
+        sx = stsc_X.scale_ if stsc_X.scale_ is not None else 1.
+        mx = stsc_X.mean_ if stsc_X.mean_ is not None else 0.
+        sy = stsc_y.scale_[0] if stsc_y.scale_ is not None else 1.
+        my = stsc_y.mean_[0] if stsc_y.mean_ is not None else 0.
+        coef = np.ravel(lr.coef_) / sx
+        intercept = float(np.ravel(lr.intercept_)[0]) - np.dot(coef, mx)
+        return dict(coef=sy*coef, intercept=float(sy*intercept + my),
+                    columns=[], R2=np.nan)
+
+    # Versión del formato del fichero del modelo
+    FORMAT_VERSION = 1
+
+    # Cantidad de modelos que se mantienen en la caché
+    CACHE_SIZE = 8
+
+    __cache = OrderedDict()
+    __lock = threading.Lock()
+
+    def __fit(chunks):
+        # Regresión lineal por mínimos cuadrados sobre los datos
+        # estandarizados (como StandardScaler + LinearRegression) a partir de
+        # estadísticos suficientes: la cantidad de filas, las medias y la
+        # matriz de co-momentos centrados de [X,y]. Los de cada bloque se
+        # combinan con los acumulados con la fórmula de Chan et al., que
+        # es numéricamente estable
+        n = 0
+        columns = None
+        for chunk_columns,data in chunks:
+            if columns is None:
+                columns = chunk_columns
+                mean = np.zeros(data.shape[1])
+                C = np.zeros((data.shape[1],data.shape[1]))
+            elif chunk_columns != columns:
+                raise ValueError('Las columnas de los descriptores no '
+                                 'coinciden.')
+            m = len(data)
+            if m == 0:
+                continue
+            chunk_mean = data.mean(axis=0)
+            d = data - chunk_mean
+            delta = chunk_mean - mean
+            C += d.T @ d + np.outer(delta, delta) * (n*m/(n+m))
+            mean += delta * (m/(n+m))
+            n += m
+        if n == 0:
+            raise ValueError('No hay datos para generar el modelo.')
+
+        # Desvíos estándar como los de StandardScaler (los nulos se toman
+        # como 1)
+        std = np.sqrt(np.diag(C) / n)
+        std[std == 0] = 1.
+        R = C / np.outer(std, std)
+        # Ecuaciones normales de la regresión estandarizada (solución de
+        # norma mínima si X no tiene rango completo, como lstsq)
+        beta = np.linalg.lstsq(R[:-1,:-1], R[:-1,-1], rcond=None)[0]
+        # R^2 = 1 - SSE/SST con SSE = Syy - 2 b·Sxy + b'Sxx b
+        sse = R[-1,-1] - 2*beta @ R[:-1,-1] + beta @ R[:-1,:-1] @ beta
+        r2 = 1 - sse/R[-1,-1] if R[-1,-1] > 0 else 1.
+        coef = std[-1] * beta / std[:-1]
+        model = dict(coef=coef,
+                     intercept=float(mean[-1] - coef @ mean[:-1]),
+                     columns=list(columns[:-1]), R2=float(r2))
+        info = dict(R2=float(r2))
+        return (model,info)
+
+
+if __name__ == '__main__':
+    # Conversión de modelos del formato anterior:
+    #     python model.py viejo.model nuevo.model
+    import sys
+    Model.convert(sys.argv[1], sys.argv[2])
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Created on Wed Oct 14 07:09:31 2026
+# @author: Fernando Camussi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" Selección de modelos
+
+Compara por validación cruzada los regresores lineales evaluados en el
+trabajo (mínimos cuadrados, Ridge, Lasso y SVR lineal) con distintos
+hiperparámetros. Los pliegues se arman por campo: todas las filas de un
+mismo fichero de descriptores quedan en el mismo pliegue. Las evaluaciones
+se reparten entre varios procesos y el mejor regresor se entrena con todos
+los datos y se guarda en el formato de Model. Ejemplo:
+    python model_selection.py -o girasol.model -k 5 campo*.npz
+"""
+
+from descriptors import Descriptors
+from model import Model
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import sys
+import time
+import numpy as np
+
+
+# Candidatos: nombre, regresor de scikit-learn e hiperparámetros
+CANDIDATES = ([('OLS', 'LinearRegression', {})] +
+              [('Ridge', 'Ridge', dict(alpha=a)) for a in (0.1, 1., 10.)] +
+              [('Lasso', 'Lasso', dict(alpha=a, max_iter=10000))
+               for a in (0.001, 0.01, 0.1)] +
+              [('LinearSVR', 'LinearSVR', dict(C=c, max_iter=10000))
+               for c in (0.1, 1., 10.)])
+
+
+def load_data(descr_files):
+    """ Carga los ficheros de descriptores
+
+    Argumentos:
+        descr_files -- lista de nombres de ficheros de descriptores
+
+    Retorna: descriptores, cantidades de plantas, número de fichero (campo)
+             de cada fila y nombres de las columnas de los descriptores
+    """
+    X = []
+    y = []
+    groups = []
+    columns = None
+    for i,descr_file in enumerate(descr_files):
+        df = Descriptors.load([descr_file])
+        if columns is None:
+            columns = list(df.columns[:-1])
+        data = df.to_numpy(np.float64)
+        X.append(data[:,:-1])
+        y.append(data[:,-1])
+        groups.append(np.full(len(data), i))
+    return (np.concatenate(X),np.concatenate(y),np.concatenate(groups),
+            columns)
+
+
+def fit(name, params, X, y):
+    """ Entrena un regresor sobre los datos estandarizados y lo pliega en
+    el formato de Model
+
+    Argumentos:
+        name -- nombre de la clase del regresor en sklearn.linear_model o
+                sklearn.svm
+        params -- hiperparámetros del regresor
+        X -- descriptores
+        y -- cantidades de plantas
+
+    Retorna: modelo
+    """
+    from sklearn import linear_model, svm
+    from sklearn.preprocessing import StandardScaler
+    cls = getattr(linear_model, name, None) or getattr(svm, name)
+    stsc_X = StandardScaler()
+    stsc_y = StandardScaler()
+    Xs = stsc_X.fit_transform(X)
+    ys = stsc_y.fit_transform(y.reshape(-1,1)).flatten()
+    regressor = cls(**params)
+    regressor.fit(Xs, ys)
+    return Model.fold(regressor, stsc_X, stsc_y)
+
+
+def evaluate(candidate, fold):
+    """ Evalúa un candidato en un pliegue (se ejecuta en los procesos del
+    pool, con los datos cargados por __init_worker)
+
+    Argumentos:
+        candidate -- índice del candidato en CANDIDATES
+        fold -- índice del pliegue
+
+    Retorna: diccionario con R2 y MAE del pliegue de prueba y los tiempos
+             de entrenamiento y de inferencia
+    """
+    X,y,folds = __data
+    test = folds == fold
+    _,name,params = CANDIDATES[candidate]
+    t = time.perf_counter()
+    model = fit(name, params, X[~test], y[~test])
+    t_fit = time.perf_counter() - t
+    t = time.perf_counter()
+    y_pred = Model.apply(model, X[test])
+    t_apply = time.perf_counter() - t
+    err = y[test] - y_pred
+    sst = ((y[test] - y[test].mean())**2).sum()
+    return dict(R2=1 - (err**2).sum()/sst if sst > 0 else np.nan,
+                MAE=np.abs(err).mean(),
+                n_fit=np.count_nonzero(~test), t_fit=t_fit,
+                n_apply=np.count_nonzero(test), t_apply=t_apply)
+
+
+def model_selection(descr_files, model_file=None, k=5, workers=None,
+                    metric='R2'):
+    """ Evalúa todos los candidatos con validación cruzada por campos y
+    guarda el mejor
+
+    Argumentos:
+        descr_files -- lista de nombres de ficheros de descriptores (cada
+                       uno es un campo)
+        model_file -- nombre del fichero donde se guarda el mejor modelo
+                      (None: no se guarda)
+        k -- cantidad de pliegues (como máximo la cantidad de ficheros)
+        workers -- cantidad de procesos (None: cantidad de CPUs)
+        metric -- métrica para elegir el mejor: 'R2' (mayor) o 'MAE' (menor)
+
+    Retorna: lista de diccionarios con los resultados promedio de cada
+             candidato y el índice del mejor
+    """
+    X,y,groups,columns = load_data(descr_files)
+    k = min(k, len(descr_files))
+    if k < 2:
+        raise ValueError('Se necesitan al menos dos ficheros de '
+                         'descriptores.')
+    folds = __group_folds(groups, k)
+
+    jobs = [(c,f) for c in range(len(CANDIDATES)) for f in range(k)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=__init_worker,
+                             initargs=(X,y,folds)) as executor:
+        scores = list(executor.map(evaluate, *zip(*jobs)))
+
+    results = []
+    for c,(label,name,params) in enumerate(CANDIDATES):
+        s = [scores[i] for i,(cc,_) in enumerate(jobs) if cc == c]
+        results.append(dict(
+            modelo=label,
+            parametros=', '.join('%s=%g' % p for p in params.items()
+                                 if p[0] != 'max_iter'),
+            R2=np.mean([x['R2'] for x in s]),
+            MAE=np.mean([x['MAE'] for x in s]),
+            fit=sum(x['n_fit'] for x in s) / sum(x['t_fit'] for x in s),
+            apply=(sum(x['n_apply'] for x in s) /
+                   max(sum(x['t_apply'] for x in s), 1e-9))))
+
+    key = (lambda r: -r['R2']) if metric == 'R2' else (lambda r: r['MAE'])
+    best = min(range(len(results)), key=lambda i: key(results[i]))
+    if model_file is not None:
+        _,name,params = CANDIDATES[best]
+        model = fit(name, params, X, y)
+        model['columns'] = columns
+        y_pred = Model.apply(model, X)
+        model['R2'] = float(1 - ((y - y_pred)**2).sum() /
+                            ((y - y.mean())**2).sum())
+        Model.save(model_file, model)
+    return (results,best)
+
+
+def __group_folds(groups, k):
+    # Asigna cada campo a un pliegue repartiendo las filas de forma
+    # equilibrada: los campos de mayor a menor cantidad de filas van al
+    # pliegue con menos filas (como GroupKFold)
+    sizes = np.bincount(groups)
+    fold_sizes = np.zeros(k, int)
+    group_fold = np.zeros(len(sizes), int)
+    for g in np.argsort(-sizes, kind='stable'):
+        group_fold[g] = np.argmin(fold_sizes)
+        fold_sizes[group_fold[g]] += sizes[g]
+    return group_fold[groups]
+
+
+def __init_worker(X, y, folds):
+    # Los datos se envían una sola vez a cada proceso. scikit-learn se
+    # importa aquí para que no cuente en los tiempos de entrenamiento
+    import sklearn.linear_model, sklearn.svm
+    global __data
+    __data = (X,y,folds)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Selección de modelos por validación cruzada.')
+    parser.add_argument('descriptors', nargs='+',
+                        help='ficheros de descriptores (.npz o .csv), uno '
+                             'por campo')
+    parser.add_argument('-o', '--output', default=None,
+                        help='fichero donde se guarda el mejor modelo')
+    parser.add_argument('-k', '--folds', type=int, default=5,
+                        help='cantidad de pliegues (por defecto: '
+                             '%(default)s)')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='cantidad de procesos (por defecto: cantidad '
+                             'de CPUs)')
+    parser.add_argument('--metric', choices=['R2', 'MAE'], default='R2',
+                        help='métrica para elegir el mejor modelo (por '
+                             'defecto: %(default)s)')
+    args = parser.parse_args(argv)
+
+    results,best = model_selection(args.descriptors, args.output,
+                                   args.folds, args.workers, args.metric)
+    print('%-10s %-12s %8s %8s %14s %14s' % ('modelo', 'parámetros', 'R2',
+                                             'MAE', 'fit (filas/s)',
+                                             'apply (filas/s)'))
+    for i,r in enumerate(results):
+        print('%-10s %-12s %8.4f %8.4f %14.0f %14.0f%s' %
+              (r['modelo'], r['parametros'], r['R2'], r['MAE'], r['fit'],
+               r['apply'], '  *' if i == best else ''))
+    if args.output is not None:
+        print('Se guardó el modelo %s (%s) en %s.' %
+              (results[best]['modelo'], results[best]['parametros'],
+               args.output), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
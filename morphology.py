@@ -23,19 +23,20 @@ import numpy as np
 import cv2 as cv
 
 
-def morphology(mask, ppm):
+def morphology(mask, ppm, ksize=None):
     """ Aplica operaciones morfológicas de apertura, remoción y relleno
     a la máscara
 
     Argumentos:
         mask -- máscara a la que se le aplican las operaciones
+        ppm -- pixeles por metro
+        ksize -- tamaño del elemento estructurante de la apertura (None: se
+                 calcula a partir de ppm)
 
     Retorna: máscara con operaciones aplicadas
     """
-
     # Apertura
-    kernel = cv.getStructuringElement(shape=cv.MORPH_ELLIPSE, ksize=(5,5))
-    mask = cv.morphologyEx(mask, cv.MORPH_OPEN, kernel)
+    mask = __opening(mask, ppm, ksize)
 
     # Remueve objetos pequeños y rellena agujeros
     U = (ppm/20)**2
@@ -45,3 +46,13 @@ def morphology(mask, ppm):
     cv.drawContours(mask2, contours, -1, 255, cv.FILLED)
 
     return mask2
+
+
+def __opening(mask, ppm, ksize):
+    # Apertura con un elemento estructurante de ksize pixeles o, si ksize es
+    # None, de unos 2,5 cm (5x5 a 200 ppm)
+    if ksize is None:
+        ksize = max(3, 2*round((ppm/40 - 1)/2) + 1)
+    kernel = cv.getStructuringElement(shape=cv.MORPH_ELLIPSE,
+                                      ksize=(ksize,ksize))
+    return cv.morphologyEx(mask, cv.MORPH_OPEN, kernel)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Created on Sun Sep 20 10:12:31 2026
+# @author: Fernando Camussi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" Preprocesamiento """
+
+from segmentation import segmentation
+from morphology import morphology
+from rows_orientation import rows_orientation
+from rotation import rotation
+import time
+import cv2 as cv
+
+
+def preprocessing(image, ppm, timings=None, mask_rotation=None,
+                  rotate_image=True):
+    """ Segmenta la imagen, detecta la orientación de las hileras y rota la
+    imagen de manera que las hileras queden horizontales
+
+    Argumentos:
+        image -- imagen
+        ppm -- pixeles por metro
+        timings -- diccionario donde se guardan los tiempos en segundos de
+                   cada etapa (opcional)
+        mask_rotation -- None para segmentar de nuevo la imagen rotada, o la
+                         interpolación ('nearest' o 'bilinear') con la que se
+                         rota directamente la máscara ya segmentada. En el
+                         caso 'bilinear' la máscara se vuelve a umbralizar
+        rotate_image -- si es False no se rota la imagen color y se retorna
+                        None en su lugar (solo tiene sentido rotando la
+                        máscara, cuando la imagen no se va a mostrar)
+
+    Retorna: imagen rotada, máscara de la imagen rotada y orientación en
+             grados. Si falla la detección de la orientación la imagen y la
+             orientación son None
+    """
+    if timings is None:
+        timings = {}
+
+    t = time.perf_counter()
+    mask = segmentation(image)
+    mask = morphology(mask, ppm)
+    timings['segmentacion'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    orientation = rows_orientation(mask, ppm=ppm, refine=True)
+    timings['orientacion'] = time.perf_counter() - t
+    if orientation is None:
+        return (None,mask,None)
+
+    t = time.perf_counter()
+    if rotate_image or mask_rotation is None:
+        image = rotation(image, -orientation)
+    else:
+        image = None
+    if mask_rotation is not None:
+        mask = rotation(mask, -orientation, mask_rotation)
+    timings['rotacion'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    if mask_rotation is None:
+        mask = segmentation(image)
+    elif mask_rotation != 'nearest':
+        _,mask = cv.threshold(mask, 127, 255, cv.THRESH_BINARY)
+    # La máscara rotada también se limpia porque pueden quedar fragmentos en
+    # los bordes de los objetos
+    mask = morphology(mask, ppm)
+    timings['segmentacion'] += time.perf_counter() - t
+
+    return (image,mask,orientation)
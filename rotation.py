@@ -19,20 +19,152 @@
 
 """ Rotación """
 
+from concurrent.futures import ThreadPoolExecutor
+import math
 import numpy as np
-from PIL import Image
+import cv2 as cv
 
 
-def rotation(image, angle):
+INTERPOLATIONS = {'nearest': cv.INTER_NEAREST,
+                  'bilinear': cv.INTER_LINEAR,
+                  'bicubic': cv.INTER_CUBIC}
+
+
+def rotation(image, angle, interpolation='bicubic', backend='opencv',
+             out=None, threads=None):
     """ Rota una imagen en sentido anti-horario
 
+    El lienzo se expande para que entre toda la imagen rotada y lo que queda
+    fuera de la imagen original se rellena con negro, igual que con
+    PIL.Image.rotate(angle, expand=True)
+
     Argumentos:
         image -- imagen a rotar
         angle -- ángulo de rotación en grados
+        interpolation -- 'nearest', 'bilinear' o 'bicubic'. Para rotar
+                         máscaras se usa 'nearest' para que sigan siendo
+                         binarias
+        backend -- 'opencv' (cv.warpAffine) o 'pil' (PIL.Image.rotate)
+        out -- array donde se escribe la imagen rotada, de las dimensiones
+               que da rotated_size (opcional, solo con 'opencv')
+        threads -- cantidad de hilos entre los que se reparten las filas de
+                   la imagen rotada (None: un solo llamado a warpAffine, que
+                   igualmente usa los hilos de OpenCV)
 
     Retorna: imagen rotada
     """
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError('Interpolación desconocida: %s' % interpolation)
+    if backend == 'pil':
+        return __rotation_pil(image, angle, interpolation)
+    elif backend != 'opencv':
+        raise ValueError('Backend de rotación desconocido: %s' % backend)
+
+    [nw,nh] = rotated_size(image.shape, angle)
+    if out is None:
+        out = np.empty((nh,nw) + image.shape[2:], image.dtype)
+    elif out.shape != (nh,nw) + image.shape[2:] or out.dtype != image.dtype:
+        raise ValueError('El array de salida no tiene las dimensiones o el '
+                         'tipo de la imagen rotada')
+
+    # Los múltiplos de 90 grados son exactos
+    k = angle % 360.0
+    if k in (0, 90, 180, 270):
+        out[...] = np.rot90(image, int(k) // 90)
+        return out
+
+    M,_ = rotation_matrix(image.shape, angle)
+    if threads is None or threads <= 1:
+        __warp(image, M, interpolation, out)
+    else:
+        # Cada hilo calcula una banda de filas de la imagen rotada
+        bands = np.array_split(np.arange(nh), threads)
+        with ThreadPoolExecutor(threads) as executor:
+            futures = []
+            for band in bands:
+                if len(band) > 0:
+                    M_band = M.copy()
+                    M_band[:,2] += M[:,1] * band[0]
+                    futures.append(executor.submit(
+                        __warp, image, M_band, interpolation,
+                        out[band[0]:band[-1]+1]))
+            # Se propagan las excepciones de los hilos
+            for future in futures:
+                future.result()
+    return out
+
+
+def rotated_size(shape, angle):
+    """ Calcula las dimensiones del lienzo de la imagen rotada
+
+    Argumentos:
+        shape -- dimensiones de la imagen
+        angle -- ángulo de rotación en grados
+
+    Retorna: ancho y alto de la imagen rotada
+    """
+    return rotation_matrix(shape, angle)[1]
+
+
+def rotation_matrix(shape, angle):
+    """ Calcula la transformación de la rotación con el mismo criterio que
+    PIL.Image.rotate con expand=True
+
+    Argumentos:
+        shape -- dimensiones de la imagen
+        angle -- ángulo de rotación en grados
+
+    Retorna: matriz de 2x3 que lleva coordenadas (x,y) de la imagen rotada a
+             coordenadas de la imagen original (ambas en índices de pixeles),
+             y ancho y alto de la imagen rotada
+    """
+    [h,w] = shape[:2]
+    k = angle % 360.0
+    # Con 90 y 270 grados PIL transpone la imagen
+    if k == 90:
+        return (np.array([[0.,-1.,w-1.],[1.,0.,0.]]),(h,w))
+    if k == 270:
+        return (np.array([[0.,1.,0.],[-1.,0.,h-1.]]),(h,w))
+    a = -math.radians(angle)
+    cos = round(math.cos(a), 15)
+    sin = round(math.sin(a), 15)
+    M = np.array([[cos, sin, 0.],
+                  [-sin, cos, 0.]])
+    center = np.array([w/2, h/2])
+    M[:,2] = center - M[:,:2] @ center
+    corners = np.array([[0,0,1],[w,0,1],[w,h,1],[0,h,1]]) @ M.T
+    nw = math.ceil(corners[:,0].max()) - math.floor(corners[:,0].min())
+    nh = math.ceil(corners[:,1].max()) - math.floor(corners[:,1].min())
+    M[:,2] = M @ (-(nw-w)/2, -(nh-h)/2, 1)
+    # PIL toma las coordenadas en el centro de los pixeles
+    M[:,2] += M[:,:2] @ (0.5,0.5) - 0.5
+    return (M,(nw,nh))
+
+
+def __warp(image, M, interpolation, out):
+    [h,w] = image.shape[:2]
+    size = (out.shape[1],out.shape[0])
+    flags = INTERPOLATIONS[interpolation] | cv.WARP_INVERSE_MAP
+    if interpolation == 'nearest':
+        cv.warpAffine(image, M, size, dst=out, flags=flags,
+                      borderMode=cv.BORDER_CONSTANT, borderValue=0)
+    else:
+        # Como PIL, cerca del borde se interpola replicando los pixeles del
+        # borde y solo se rellena con negro lo que cae fuera de la imagen
+        cv.warpAffine(image, M, size, dst=out, flags=flags,
+                      borderMode=cv.BORDER_REPLICATE)
+        inside = cv.warpAffine(np.ones((h,w), np.uint8), M, size,
+                               flags=cv.INTER_NEAREST | cv.WARP_INVERSE_MAP,
+                               borderMode=cv.BORDER_CONSTANT, borderValue=0)
+        out[inside == 0] = 0
+
+
+def __rotation_pil(image, angle, interpolation):
+    from PIL import Image
+    resample = {'nearest': Image.NEAREST,
+                'bilinear': Image.BILINEAR,
+                'bicubic': Image.BICUBIC}[interpolation]
     image = Image.fromarray(image)
-    image = image.rotate(angle, Image.BICUBIC, expand=True)
+    image = image.rotate(angle, resample, expand=True)
     image = np.asarray(image)
     return image
@@ -19,67 +19,86 @@
 
 """ Detección de las filas """
 
-import cv2 as cv
+from blobs import Blobs
+from packed_mask import PackedMask
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 #from matplotlib import pyplot as plt
-from scipy.signal import find_peaks, peak_widths
 
+# Cantidad mínima de franjas que debe abarcar una hilera en el modo por
+# franjas. Los fragmentos más cortos suelen ser centros que no se pudieron
+# enlazar con su hilera y no se cuentan
+MIN_STRIPS = 2
 
-def rows_detection(mask, ppm):
+
+def rows_detection(mask, ppm, strip=None, threads=None, blobs=None):
     """ Detecta las hileras y los contornos de los objetos pertenecientes a
         las mismas
 
     Argumentos:
         mask -- máscara
+        ppm -- pixeles por metro
+        strip -- ancho en pixeles de las franjas verticales en las que se
+                 buscan las hileras por separado (ver rows_polylines), para
+                 hileras levemente curvas. Si es None se usa un único perfil
+                 de toda la máscara (hileras rectas)
+        threads -- cantidad de hilos con los que se procesan las franjas
+        blobs -- tabla de objetos de la máscara (Blobs), si ya se calculó
 
-    Retorna: lista de contornos de objetos que pertenecen a alguna hilera y
-             una lista de lista con los puntos que forman las hileras
+    Retorna: tabla con los objetos que pertenecen a alguna hilera (con la
+             hilera asignada), total de hileras y una lista de lista con los
+             puntos que forman las hileras
     """
 
-    # Perfiles acumulados (horizontalmente)
-    profiles = np.array(list(map(sum, mask)))
+    # Objetos de la máscara
+    if blobs is None:
+        blobs = Blobs.fromMask(mask)
 
-    # Normalizo profiles entre 0 y 1
-    profiles = profiles / profiles.max()
-
-    # Busco máximos locales (centro de hileras) y sus anchos
-    row_centers,_ = find_peaks(profiles, prominence=0.1, distance=ppm/10)
-    widths = peak_widths(profiles, row_centers, rel_height=1/2)[0]
-
-    # plt.plot(range(len(profiles)), profiles)
-    # y = profiles[row_centers]
-    # plt.plot(row_centers, y, '*')
-
-    # Contornos de los objetos de la máscara
-    contours,_ = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)
+    # Centroides truncados a enteros y extremos en x de los bounding boxes
+    cens = blobs.centroid.astype(int)
+    bb_x1 = blobs.bbox[:,0].astype(int)
+    bb_x2 = bb_x1 + blobs.bbox[:,2]
 
     # Asigno cada objeto a un centro de hilera en base al umbral widths y el
-    # centroide del objeto en el eje y
-    rows = [[] for _ in range(len(row_centers))]
-    for i in range(len(rows)):
-        for cnt in contours:
-            cen = __centroid(cnt)  
-            if (row_centers[i] - widths[i] < cen[1] and
-                cen[1] < row_centers[i] + widths[i]):
-                rows[i].append(cnt)
+    # centroide del objeto en el eje y. Con los objetos ordenados por la
+    # coordenada y del centroide, los que caen en la banda de cada hilera
+    # son un intervalo que se busca con searchsorted. Un objeto puede
+    # pertenecer a más de una banda. Dentro de cada hilera los objetos
+    # quedan en el orden de los contornos
+    order = np.argsort(cens[:,1], kind='stable')
+    cys = cens[order,1]
+    if strip is None:
+        row_centers,widths = rows_centers(mask, ppm)
+        lo = np.searchsorted(cys, row_centers - widths, 'right')
+        hi = np.searchsorted(cys, row_centers + widths, 'left')
+        rows = [np.sort(order[a:b]) for a,b in zip(lo, hi)]
+    else:
+        # En modo franjas el centro y el ancho de cada hilera se interpolan
+        # en la coordenada x del centroide. La búsqueda con searchsorted se
+        # restringe al rango en y que ocupa la hilera
+        polylines = rows_polylines(mask, ppm, strip, threads)
+        bounds = __strips(mask.shape[1], strip)
+        centers = (bounds[:,0] + bounds[:,1] - 1) / 2
+        rows = []
+        for xs,ys,ws in polylines:
+            # Rango en x de las franjas que cubre la hilera
+            x0 = bounds[np.searchsorted(centers, xs[0]),0]
+            x1 = bounds[np.searchsorted(centers, xs[-1]),1]
+            a = np.searchsorted(cys, (ys - ws).min(), 'right')
+            b = np.searchsorted(cys, (ys + ws).max(), 'left')
+            idx = np.sort(order[a:b])
+            cx = cens[idx,0]
+            cy = cens[idx,1]
+            yc = np.interp(cx, xs, ys)
+            wc = np.interp(cx, xs, ws)
+            rows.append(idx[(x0 <= cx) & (cx < x1) &
+                            (yc - wc < cy) & (cy < yc + wc)])
+        widths = np.array([np.median(ws) for _,_,ws in polylines])
 
     # Se eliminan los objetos que tienen las coordenadas x de su bounding
-    # box contenido en las coordenadas x del bounding box de otro objeto
-    rows2 = [[] for _ in range(len(rows))]
-    for i in range(len(rows)):
-        for j in range(len(rows[i])):
-            # Si el objeto a agregar no está completamente contenido en algún
-            # objeto de row2...
-            if len([x for x in rows2[i] if __inBBx(rows[i][j],x)]) == 0:
-                e = [k for k in range(len(rows2[i]))
-                         if __inBBx(rows2[i][k],rows[i][j])]
-                # Si en row2 hay objetos completamente contenidos en el
-                # objeto a agregar se eliminan
-                if len(e) > 0:
-                    rows2[i] = [rows2[i][k] for k in range(len(rows2[i]))
-                                    if k not in e]
-                # Se agrega el objeto
-                rows2[i].append(rows[i][j])
+    # box contenido en las coordenadas x del bounding box de otro objeto de
+    # la misma hilera (si son iguales se conserva el primero)
+    rows2 = [row[__uncontained(bb_x1[row], bb_x2[row])] for row in rows]
 
     # Para cada hilera se ordenan los objetos por posición x de su centroide
     # de menor a mayor. Luego se filtran los objetos que están fuera del
@@ -88,41 +107,178 @@ def rows_detection(mask, ppm):
     # objetos
     rows3 = [[] for _ in range(len(rows2))]
     for i in range(len(rows2)):
-        rows2[i] = sorted(rows2[i], key=lambda x: __centroid(x)[0])
-        for cnt in rows2[i]:
-            cen = __centroid(cnt)
+        row = rows2[i][np.argsort(cens[rows2[i],0], kind='stable')]
+        for j in row:
             if len(rows3[i]) < 3:
-                rows3[i].append(cnt)
+                rows3[i].append(j)
             else:
-                row_centers[i] = sum([__centroid(c)[1] for c in
-                                          rows3[i][-3:len(rows3[i])]])/3
-                if (row_centers[i] - widths[i]/2 < cen[1] and
-                    cen[1] < row_centers[i] + widths[i]/2):
-                    rows3[i].append(cnt)
-
-    # Calcula las lineas de centroide a centroide
-    centroids = [list(map(__centroid, r)) for r in rows3]
-    centroids = [sorted(r, key=lambda x: x[0]) for r in centroids]
-    lines = [[list(cs[c]+cs[c+1]) for c in range(len(cs)-1)]
-             for cs in centroids]
-    lines = [l for ls in lines for l in ls]
-
-    contours2 = [x for r in rows3 for x in r]
-    total_rows = len(row_centers)
-    #print(len(contours))
-    #print(len(contours2))
-
-    return (contours2,total_rows,lines)
-
-
-def __centroid(cnt):
-    M = cv.moments(cnt)
-    cx = int(M['m10']/M['m00'])
-    cy = int(M['m01']/M['m00'])
-    return (cx,cy)
-
-
-def __inBBx(cnt1, cnt2):
-    [x1,_,w1,_] = cv.boundingRect(cnt1)
-    [x2,_,w2,_] = cv.boundingRect(cnt2)
-    return x2 <= x1 and x1+w1 <= x2+w2
+                center = int(cens[rows3[i][-3:],1].sum()/3)
+                if (center - widths[i]/2 < cens[j,1] and
+                    cens[j,1] < center + widths[i]/2):
+                    rows3[i].append(j)
+
+    # Calcula las lineas de centroide a centroide (los objetos de cada
+    # hilera ya están ordenados por x)
+    lines = []
+    for r in rows3:
+        cs = cens[r]
+        lines += np.hstack((cs[:-1], cs[1:])).tolist()
+
+    blobs2 = blobs.take(np.concatenate([np.zeros(0, int)] + rows3))
+    blobs2.row = np.repeat(np.arange(len(rows3), dtype=np.int32),
+                           [len(r) for r in rows3])
+    total_rows = len(rows)
+
+    return (blobs2,total_rows,lines)
+
+
+def rows_centers(mask, ppm, distance=None):
+    """ Detecta los centros de las hileras a partir del perfil acumulado
+        horizontalmente
+
+    Argumentos:
+        mask -- máscara (array o PackedMask)
+        ppm -- pixeles por metro
+        distance -- distancia mínima en pixeles entre centros de hileras. Si
+                    es None se usa la correspondiente a 0,1 m
+
+    Retorna: array con las coordenadas y de los centros de las hileras y
+             array con sus anchos
+    """
+
+    # scipy.signal tarda en importarse, se carga recién al usarlo
+    from scipy.signal import find_peaks, peak_widths
+
+    # Perfiles acumulados (horizontalmente). Se cuentan los bits de la
+    # máscara empaquetada, que es más rápido que sumar los bytes
+    if not isinstance(mask, PackedMask):
+        mask = PackedMask.fromDense(mask)
+    profiles = mask.rowSums()
+    if profiles.max() == 0:
+        return (np.zeros(0, np.intp),np.zeros(0))
+
+    # Normalizo profiles entre 0 y 1
+    profiles = profiles / profiles.max()
+
+    # Busco máximos locales (centro de hileras) y sus anchos
+    if distance is None:
+        distance = ppm/10
+    row_centers,_ = find_peaks(profiles, prominence=0.1,
+                               distance=max(distance, 1))
+    widths = peak_widths(profiles, row_centers, rel_height=1/2)[0]
+
+    # plt.plot(range(len(profiles)), profiles)
+    # y = profiles[row_centers]
+    # plt.plot(row_centers, y, '*')
+
+    return (row_centers,widths)
+
+
+def rows_polylines(mask, ppm, strip, threads=None):
+    """ Detecta las hileras como polilíneas dividiendo la máscara en franjas
+        verticales. En cada franja se buscan los centros de las hileras con
+        rows_centers y luego se enlazan los de franjas vecinas
+
+    Argumentos:
+        mask -- máscara con las hileras aproximadamente horizontales
+        ppm -- pixeles por metro
+        strip -- ancho de las franjas en pixeles
+        threads -- cantidad de hilos entre los que se reparten las franjas
+
+    Retorna: lista de polilíneas ordenadas por su posición en y, cada una
+             como tres arrays: coordenadas x (centros de las franjas), y
+             (centros de la hilera) y anchos de la hilera. Las polilíneas
+             que abarcan menos de MIN_STRIPS franjas se descartan
+    """
+    # El perfil de toda la máscara da la distancia típica entre hileras y
+    # su ancho. En franjas angostas hay pocas plantas por hilera y los
+    # picos salen más angostos que la hilera, por lo que el ancho global se
+    # usa como mínimo. Si una hilera curva se desplaza mucho dentro de una
+    # franja su pico se ensancha y puede partirse en dos; con la distancia
+    # mínima de la mitad del espaciado se conserva el más alto
+    centers,widths = rows_centers(mask, ppm)
+    if len(centers) > 1:
+        spacing = np.median(np.diff(centers))
+    else:
+        spacing = ppm
+    width = np.median(widths) if len(widths) > 0 else 0
+
+    bounds = __strips(mask.shape[1], strip)
+    fun = lambda b: rows_centers(mask[:,b[0]:b[1]], ppm, spacing/2)
+    if threads is None or threads <= 1:
+        peaks = list(map(fun, bounds))
+    else:
+        with ThreadPoolExecutor(threads) as executor:
+            peaks = list(executor.map(fun, bounds))
+    peaks = [(c,np.maximum(w, width)) for c,w in peaks]
+
+    # Tolerancia para enlazar: la mitad de la distancia entre hileras
+    tol = spacing/2
+
+    # Cada centro se enlaza con la polilínea más cercana cuyo último punto
+    # está en una de las dos franjas anteriores (se tolera una franja sin
+    # detectar). La posición de la polilínea se extrapola con la pendiente
+    # de sus dos últimos puntos, para seguir a las hileras curvas. Los
+    # emparejamientos se eligen por distancia creciente
+    polylines = []
+    for k,((x0,x1),(centers,widths)) in enumerate(zip(bounds, peaks)):
+        x = (x0 + x1 - 1) / 2
+        active = [p for p in polylines if p[4] >= k-2]
+        free = np.ones(len(centers), bool)
+        if len(active) > 0 and len(centers) > 0:
+            pred = np.array([__extrapolate(p[0], p[1], x) for p in active])
+            d = np.abs(pred[:,None] - centers[None,:])
+            used = np.zeros(len(active), bool)
+            for i,j in zip(*np.unravel_index(np.argsort(d, axis=None),
+                                             d.shape)):
+                if d[i,j] >= tol:
+                    break
+                if used[i] or not free[j]:
+                    continue
+                used[i] = True
+                free[j] = False
+                active[i][0].append(x)
+                active[i][1].append(centers[j])
+                active[i][2].append(widths[j])
+                active[i][4] = k
+        for j in np.flatnonzero(free):
+            polylines.append([[x],[centers[j]],[widths[j]],k,k])
+
+    # Se descartan los fragmentos que abarcan menos de MIN_STRIPS franjas
+    # (o menos que todas, si la máscara tiene menos franjas)
+    n = min(MIN_STRIPS, len(bounds))
+    polylines = [(np.array(xs),np.array(ys, float),np.array(ws))
+                 for xs,ys,ws,k0,k1 in polylines if k1 - k0 + 1 >= n]
+    polylines.sort(key=lambda p: p[1].mean())
+    return polylines
+
+
+def __extrapolate(xs, ys, x):
+    # Posición en x de la recta que pasa por los dos últimos puntos de una
+    # polilínea (o del último, si tiene uno solo)
+    if len(xs) < 2:
+        return ys[-1]
+    return ys[-1] + (ys[-1] - ys[-2]) * (x - xs[-1]) / (xs[-1] - xs[-2])
+
+
+def __strips(w, strip):
+    # Límites [x0,x1) de las franjas verticales de un ancho lo más cercano
+    # posible a strip que cubren un ancho w
+    n = max(1, round(w/strip))
+    x = np.linspace(0, w, n+1).astype(int)
+    return np.column_stack((x[:-1], x[1:]))
+
+
+def __uncontained(x1, x2):
+    # Máscara de los intervalos [x1,x2] que no están contenidos en ningún
+    # otro. Se recorren ordenados por x1 creciente, x2 decreciente y
+    # posición, de modo que los que pueden contener a un intervalo son los
+    # anteriores, y está contenido si el máximo x2 de ellos lo alcanza
+    if len(x1) == 0:
+        return np.zeros(0, bool)
+    order = np.lexsort((np.arange(len(x1)), -x2, x1))
+    x2 = x2[order]
+    reach = np.maximum.accumulate(x2)
+    keep = np.empty(len(x1), bool)
+    keep[order] = np.concatenate(([True], x2[1:] > reach[:-1]))
+    return keep
@@ -21,17 +21,66 @@
 
 import cv2 as cv
 import numpy as np
-from scipy.signal import correlate
+import time
 
 
-def rows_orientation(mask, h_crop=4000, w_crop=4000):
+# Resolución (pixeles por metro) del nivel grueso de la pirámide. Con hileras
+# separadas unos 0,5 a 0,7 m quedan más de 10 pixeles entre hileras
+PYRAMID_PPM = 20
+
+# Suavizado del método del tensor de estructura, en metros: a lo largo de
+# las hileras abarca varias plantas para unirlas aun en campos ralos y a lo
+# ancho es menor que un cuarto de la distancia entre hileras
+ALONG_SIGMA = 1.
+ACROSS_SIGMA = 0.1
+
+# Coherencia mínima del tensor de estructura. Por debajo la máscara no tiene
+# una dirección dominante (en campos con 10% de plantas es de 0,04 o más y
+# con objetos al azar no llega a 0,02)
+COHERENCE_MIN = 0.03
+
+
+def rows_orientation(mask, h_crop=4000, w_crop=4000, lags=1., ppm=None,
+                     refine=False, timings=None, method='autocorrelation'):
     """ Calcula la orientación de las hileras
 
+    Si se indica ppm la orientación se calcula sobre la máscara reducida a
+    PYRAMID_PPM pixeles por metro, y opcionalmente se refina en un rango
+    angular estrecho a una resolución 4 veces mayor
+
     Argumentos:
         mask -- máscara de la imagen
+        h_crop, w_crop -- dimensiones máximas de la parte central de la
+                          máscara que se usa
+        lags -- fracción de las dimensiones de la máscara hasta la que se
+                calcula la auto-correlación en cada sentido. Con 1 (por
+                defecto) es la auto-correlación completa, como la
+                implementación anterior; con valores menores se usa menos
+                memoria pero el ángulo puede diferir en centésimas de grado
+        ppm -- pixeles por metro de la máscara (None: no se reduce). Es
+               obligatorio para los métodos 'hough' y 'structure_tensor'
+        refine -- si es True se refina la orientación del nivel grueso
+        timings -- diccionario donde se guardan los tiempos en segundos de
+                   cada nivel, 'grueso' y 'fino' (opcional)
+        method -- método del nivel grueso (ver METHODS):
+                  'autocorrelation' -- objeto central de la auto-correlación
+                  'hough' -- votación de Hough sobre el esqueleto de las
+                             hileras
+                  'structure_tensor' -- dirección dominante del tensor de
+                                        estructura
 
-    Retorna: orientación en grados o None en caso de error
+    Retorna: orientación en grados o None en caso de error. 'hough'
+             retorna None si ninguna recta tiene votos suficientes (campos
+             ralos) y 'structure_tensor' si la coherencia del tensor es
+             menor que COHERENCE_MIN, para que se pueda usar otro método
     """
+    if timings is None:
+        timings = {}
+    if method not in METHODS:
+        raise ValueError('Método de orientación desconocido: %s' % method)
+    if method != 'autocorrelation' and ppm is None:
+        raise ValueError('El método %s requiere ppm' % method)
+    t = time.perf_counter()
 
     # Si la máscara supera cierto tamaño se toma solo una parte central
     [h,w] = mask.shape
@@ -44,9 +93,36 @@ def rows_orientation(mask, h_crop=4000, w_crop=4000):
     mask = mask[h_s:h_s+h_crop,
                 w_s:w_s+w_crop]
 
+    # Nivel grueso
+    if ppm is not None and ppm > PYRAMID_PPM:
+        coarse = __resize(mask, PYRAMID_PPM/ppm)
+        coarse_ppm = PYRAMID_PPM
+    else:
+        coarse = mask
+        coarse_ppm = ppm
+    orientation = METHODS[method](coarse, coarse_ppm, lags)
+    timings['grueso'] = time.perf_counter() - t
+
+    # Nivel fino
+    if orientation is not None and refine and ppm is not None:
+        t = time.perf_counter()
+        scale = min(1., 4*PYRAMID_PPM/ppm)
+        fine = __resize(mask, scale) if scale < 1 else mask
+        # El error del nivel grueso es del orden de un pixel sobre el ancho
+        # de la ventana
+        width = max(0.2, 2*np.degrees(1/min(coarse.shape)))
+        orientation = __refine(fine, orientation, width)
+        timings['fino'] = time.perf_counter() - t
+
+    return orientation
+
+
+def __blob_orientation(mask, ppm, lags):
+    # Orientación del objeto central de la auto-correlación de la máscara
+
     # Auto-correlación + Otsu
     mask = cv.normalize(mask, None, 0, 1, cv.NORM_MINMAX, cv.CV_32F)
-    xc = correlate(mask, mask, mode = 'full', method='fft')
+    xc = autocorrelation(mask, lags)
     xc = cv.normalize(xc, None, 0, 255, cv.NORM_MINMAX, cv.CV_8U)
     _,xc_bin = cv.threshold(xc, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
 
@@ -63,10 +139,10 @@ def rows_orientation(mask, h_crop=4000, w_crop=4000):
         # Calculo la orientación del objeto central calculando el ángulo del
         # autovector asociado al menor autovalor en valor absoluto de la
         # matriz de covarianza C
-        z = np.matrix(cnt_center[:,0,:])
+        z = cnt_center[:,0,:].astype(np.float64)
         K = z.shape[0]
-        z_ = np.sum(z,axis=0)/K
-        C = np.sum([np.matmul((zk-z_).T,zk-z_) for zk in z],axis=0)/(K-1)
+        z -= z.mean(axis=0)
+        C = z.T @ z / (K-1)
         eigval,eigvec = np.linalg.eig(C)
         v = eigvec[np.where(eigval == np.abs(eigval).max())][0]
         orientation = np.degrees(np.arctan2(v[1],v[0]))
@@ -74,3 +150,182 @@ def rows_orientation(mask, h_crop=4000, w_crop=4000):
     else:
         # Si no hay blob central retorno None
         return None
+
+
+def __hough_orientation(mask, ppm, lags):
+    # Une las plantas de cada hilera suavizando, esqueletiza las hileras y
+    # toma la dirección dominante de las rectas de Hough más votadas
+    stripes = __stripes(mask, ppm)
+    _,stripes = cv.threshold(stripes, 0, 255,
+                             cv.THRESH_BINARY + cv.THRESH_OTSU)
+    skeleton = __skeleton(stripes)
+    lines = cv.HoughLines(skeleton, 1, np.pi/720,
+                          max(10, int(0.2*min(skeleton.shape))))
+    if lines is None:
+        # En campos muy ralos puede no haber rectas con votos suficientes
+        return None
+    theta = lines[:20,0,1]
+    # Promedio circular de las normales (módulo 180 grados)
+    theta = 0.5 * np.arctan2(np.sin(2*theta).sum(), np.cos(2*theta).sum())
+    return __normal_to_orientation(theta)
+
+
+def __structure_tensor_orientation(mask, ppm, lags, steps=24, fine_steps=9):
+    # Energía del gradiente a través de las hileras de la máscara suavizada
+    # de forma anisotrópica (ALONG_SIGMA a lo largo de la dirección
+    # candidata y ACROSS_SIGMA a lo ancho) para un banco de direcciones. Se
+    # calcula en frecuencia con el espectro de potencia: E(o) es la suma de
+    # P(f)·|H_o(f)|²·(f·n_o)². La orientación es la de máxima energía, que se
+    # refina con un segundo banco más fino e interpolación parabólica.
+    # Con las energías se arma el tensor T = Σ E_k n_k n_kᵀ, cuya coherencia
+    # (λ1-λ2)/(λ1+λ2) mide qué tan marcada es la dirección dominante
+    x = mask.astype(np.float32)
+    x -= x.mean()
+    F = np.fft.fft2(x)
+    power = F.real**2 + F.imag**2
+    fy = np.fft.fftfreq(x.shape[0])[:,None] * ppm
+    fx = np.fft.fftfreq(x.shape[1])[None,:] * ppm
+    # Solo las frecuencias que deja pasar el suavizado a lo ancho
+    rho = np.hypot(fx, fy)
+    sel = (rho > 0) & (rho < 3 / (2*np.pi*ACROSS_SIGMA))
+    fx = np.broadcast_to(fx, power.shape)[sel]
+    fy = np.broadcast_to(fy, power.shape)[sel]
+    power = power[sel]
+
+    def energy(orientations):
+        E = np.empty(len(orientations))
+        for k,o in enumerate(orientations):
+            # Componentes de la frecuencia a lo largo y a través de las
+            # hileras de orientación o (con el criterio de
+            # __normal_to_orientation)
+            fr = fx*np.cos(o) - fy*np.sin(o)
+            fn = fx*np.sin(o) + fy*np.cos(o)
+            E[k] = (power * fn**2 *
+                    np.exp(-4*np.pi**2 * (ALONG_SIGMA**2 * fr**2 +
+                                          ACROSS_SIGMA**2 * fn**2))).sum()
+        return E
+
+    orientations = np.arange(steps) * np.pi/steps - np.pi/2
+    E = energy(orientations)
+    if E.sum() == 0:
+        return None
+    coherence = abs((E * np.exp(2j*orientations)).sum()) / E.sum()
+    if coherence < COHERENCE_MIN:
+        return None
+
+    orientations = (orientations[E.argmax()] +
+                    np.linspace(-1, 1, fine_steps) * np.pi/steps)
+    E = energy(orientations)
+    i = int(E.argmax())
+    orientation = orientations[i]
+    if 0 < i < fine_steps-1:
+        # Interpolación parabólica del logaritmo de la energía
+        l,m,r = np.log(E[i-1:i+2])
+        den = l - 2*m + r
+        if den < 0:
+            orientation += (0.5 * (l-r) / den *
+                            (orientations[1]-orientations[0]))
+    orientation = np.degrees(orientation)
+    return (orientation + 90) % 180 - 90
+
+
+def __stripes(mask, ppm):
+    # Suaviza la máscara para que las plantas de una hilera formen una
+    # franja continua sin unir hileras vecinas
+    return cv.GaussianBlur(mask, (0,0), max(1., 0.1*ppm))
+
+
+def __skeleton(mask):
+    # Esqueleto morfológico (Lantuéjoul)
+    kernel = cv.getStructuringElement(cv.MORPH_CROSS, (3,3))
+    skeleton = np.zeros_like(mask)
+    while cv.countNonZero(mask) > 0:
+        eroded = cv.erode(mask, kernel)
+        opened = cv.dilate(eroded, kernel)
+        skeleton |= cv.subtract(mask, opened)
+        mask = eroded
+    return skeleton
+
+
+def __normal_to_orientation(phi):
+    # Convierte el ángulo phi (radianes) de la normal a las hileras en la
+    # orientación en grados con el mismo criterio que el método de
+    # auto-correlación (las hileras quedan horizontales rotando -orientación)
+    orientation = 90 - np.degrees(phi)
+    return (orientation + 90) % 180 - 90
+
+
+def __refine(mask, orientation, width, steps=21, max_points=1000000):
+    # Busca en [orientation-width,orientation+width] el ángulo que hace más
+    # marcado el perfil de la máscara proyectada sobre la normal a las
+    # hileras (el de mayor varianza)
+    ys,xs = np.nonzero(mask)
+    weights = mask[ys,xs].astype(np.float32)
+    if len(xs) > max_points:
+        step = int(np.ceil(len(xs) / max_points))
+        xs,ys,weights = xs[::step],ys[::step],weights[::step]
+    xs = xs.astype(np.float32)
+    ys = ys.astype(np.float32)
+    angles = orientation + np.linspace(-width, width, steps)
+    scores = np.empty(steps)
+    for i,a in enumerate(np.radians(angles)):
+        d = xs*np.float32(np.sin(a)) + ys*np.float32(np.cos(a))
+        d -= d.min()
+        profile = np.bincount(d.astype(np.int32), weights)
+        scores[i] = profile.var()
+    i = int(scores.argmax())
+    if 0 < i < steps-1:
+        # Interpolación parabólica alrededor del máximo
+        den = scores[i-1] - 2*scores[i] + scores[i+1]
+        if den < 0:
+            delta = 0.5 * (scores[i-1] - scores[i+1]) / den
+            return angles[i] + delta * (angles[1]-angles[0])
+    return angles[i]
+
+
+def __resize(mask, scale):
+    return cv.resize(mask, None, fx=scale, fy=scale,
+                     interpolation=cv.INTER_AREA)
+
+
+def autocorrelation(x, lags=1.):
+    """ Calcula la auto-correlación de un array 2D con FFT en float32,
+    conservando solo la ventana central de desplazamientos
+
+    Se rellena con ceros hasta un tamaño eficiente para la FFT que alcance
+    para que los desplazamientos de la ventana no se solapen circularmente
+
+    Argumentos:
+        x -- array 2D
+        lags -- fracción de las dimensiones de x hasta la que se calculan
+                los desplazamientos en cada sentido
+
+    Retorna: auto-correlación de (2*lh+1)x(2*lw+1) con el desplazamiento
+             nulo en el centro, siendo lh y lw los desplazamientos máximos.
+             Con lags=1 es igual a correlate(x, x, mode='full')
+    """
+    from scipy import fft
+    [h,w] = x.shape
+    lh = max(1, min(h-1, int(h*lags)))
+    lw = max(1, min(w-1, int(w*lags)))
+    H = fft.next_fast_len(h+lh, real=True)
+    W = fft.next_fast_len(w+lw, real=True)
+    F = fft.rfft2(x.astype(np.float32, copy=False), s=(H,W), workers=-1)
+    # Espectro de potencia en el lugar
+    power = np.square(F.real)
+    power += np.square(F.imag)
+    F.real = power
+    F.imag = 0
+    del power
+    xc = fft.irfft2(F, s=(H,W), overwrite_x=True, workers=-1)
+    del F
+    # Ventana central: desplazamientos -lh..lh y -lw..lw
+    rows = np.r_[H-lh:H, 0:lh+1]
+    cols = np.r_[W-lw:W, 0:lw+1]
+    return xc[np.ix_(rows,cols)]
+
+
+# Métodos para estimar la orientación en el nivel grueso
+METHODS = {'autocorrelation': __blob_orientation,
+           'hough': __hough_orientation,
+           'structure_tensor': __structure_tensor_orientation}
@@ -20,30 +20,108 @@
 """ Segmentación """
 
 import cv2 as cv
+import numpy as np
 
 
-def segmentation(image):
+def segmentation(image, threshold=None):
     """ Segmenta la imagen
 
     Argumentos:
         image -- imagen
+        threshold -- umbral del ExG. Si es None se calcula con Otsu sobre la
+                     imagen, sino se usa el umbral dado (por ejemplo uno
+                     global calculado con otsu_threshold para que todas las
+                     teselas de una imagen usen el mismo)
 
     Retorna: máscara obtenida
     """
-    R = image[:,:,2]
-    G = image[:,:,1]
-    B = image[:,:,0]
+    ExG = exg(image)
 
-    R = R.astype(int)
-    G = G.astype(int)
-    B = B.astype(int)
+    if threshold is None:
+        _,mask = cv.threshold(ExG, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
+    else:
+        _,mask = cv.threshold(ExG, threshold, 255, cv.THRESH_BINARY)
 
-    ExG = 2*G-R-B
-    ExG[ExG>255] = 255
-    ExG[ExG<0] = 0
+    return mask
 
-    ExG = ExG.astype('uint8')
 
-    _,mask = cv.threshold(ExG, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
+def exg(image, out=None, rows=64):
+    """ Calcula el índice ExG (exceso de verde) de la imagen
 
-    return mask
\ No newline at end of file
+    Se calcula por bandas de filas con aritmética int16 en el lugar, de modo
+    que la memoria temporal es de una banda y no de varias copias int64 de la
+    imagen completa
+
+    Argumentos:
+        image -- imagen
+        out -- array uint8 donde se escribe el resultado (opcional)
+        rows -- cantidad de filas de cada banda
+
+    Retorna: ExG recortado al rango [0,255] como uint8
+    """
+    [h,w] = image.shape[:2]
+    if out is None:
+        out = np.empty((h,w), np.uint8)
+    tmp = np.empty((min(rows, h),w), np.int16)
+    for y in range(0, h, rows):
+        band = image[y:y+rows]
+        t = tmp[:band.shape[0]]
+        # ExG = 2*G-R-B
+        np.multiply(band[:,:,1], 2, out=t, dtype=np.int16)
+        np.subtract(t, band[:,:,2], out=t)
+        np.subtract(t, band[:,:,0], out=t)
+        np.clip(t, 0, 255, out=t)
+        out[y:y+band.shape[0]] = t
+    return out
+
+
+def exg_histogram(image, hist=None):
+    """ Acumula el histograma de 256 bins del ExG de la imagen. Llamándola
+    con cada tesela se obtiene el histograma de la imagen completa
+
+    Argumentos:
+        image -- imagen (o tesela, o array de Nx3 pixeles muestreados)
+        hist -- histograma donde se acumula (None: se crea uno nuevo)
+
+    Retorna: histograma acumulado
+    """
+    if hist is None:
+        hist = np.zeros(256, np.int64)
+    if image.ndim == 2:
+        image = image[np.newaxis]
+    hist += np.bincount(exg(image).ravel(), minlength=256)
+    return hist
+
+
+def otsu_threshold(hist):
+    """ Calcula el umbral de Otsu a partir de un histograma. Es el mismo
+    cálculo que hace OpenCV con THRESH_OTSU, por lo que para el histograma de
+    una imagen se obtiene el mismo umbral
+
+    Argumentos:
+        hist -- histograma de 256 bins
+
+    Retorna: umbral
+    """
+    N = hist.sum()
+    if N == 0:
+        return 0
+    scale = 1. / N
+    p = hist * scale
+    mu = float(np.dot(np.arange(256), hist)) * scale
+    q1 = mu1 = max_sigma = 0.
+    max_val = 0
+    eps = np.finfo(np.float32).eps
+    for i in range(256):
+        mu1 *= q1
+        q1 += p[i]
+        q2 = 1. - q1
+        if min(q1, q2) < eps or max(q1, q2) > 1. - eps:
+            continue
+        mu1 = (mu1 + i*p[i]) / q1
+        mu2 = (mu - q1*mu1) / q2
+        sigma = q1*q2*(mu1 - mu2)**2
+        if sigma > max_sigma:
+            max_sigma = sigma
+            max_val = i
+    return max_val
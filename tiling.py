@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Created on Mon Sep 21 13:29:31 2026
+# @author: Fernando Camussi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+""" Procesamiento por teselas
+
+Permite procesar ortomosaicos que no entran en memoria. La imagen se lee por
+ventanas (teselas más un solapamiento), cada ventana se segmenta y se limpia
+por separado y solo se escribe su parte central (núcleo) en una máscara
+mapeada a disco. El conteo también se hace por ventanas sobre esa máscara:
+cada objeto se asigna a la tesela cuyo núcleo contiene su centroide, de modo
+que los objetos de los bordes no se pierden ni se cuentan dos veces. El
+solapamiento debe ser mayor que el objeto más grande.
+
+El total de hileras y la cantidad de plantas dependen del tamaño de la
+tesela: el filtro de prominencia de rows_centers se aplica al perfil de cada
+ventana, por lo que las hileras cortas de las esquinas, que con la imagen
+completa quedan descartadas, se conservan en las ventanas chicas junto con
+sus objetos. En un campo sintético de 3000x4000 pasar de teselas de 5000 a
+500 pixeles lleva las hileras de 51 a 54 y las plantas de 7475 a 7506.
+"""
+
+from segmentation import segmentation, exg_histogram, otsu_threshold
+from morphology import morphology
+from rows_orientation import rows_orientation
+from rows_detection import rows_detection, rows_centers
+from rotation import rotation, rotation_matrix
+from descriptors import Descriptors
+from model import Model
+import os
+import tempfile
+import time
+import cv2 as cv
+import numpy as np
+
+
+class TiledImage():
+
+    """ Imagen que se lee por ventanas sin cargarla completa en memoria """
+
+    def __init__(self, image):
+        """ Argumentos:
+            image -- nombre del fichero de la imagen o array (BGR)
+
+            Los ficheros .npy (BGR) y los TIFF sin compresión (si está
+            instalado tifffile) se mapean a memoria. El resto de los formatos
+            se cargan completos con OpenCV.
+        """
+        self.rgb = False
+        if not isinstance(image, str):
+            self.image = image
+        elif image.lower().endswith('.npy'):
+            self.image = np.load(image, mmap_mode='r')
+        else:
+            self.image = None
+            if image.lower().endswith(('.tif', '.tiff')):
+                try:
+                    import tifffile
+                    self.image = tifffile.memmap(image, mode='r')
+                    self.rgb = True
+                except (ImportError, ValueError):
+                    pass
+            if self.image is None:
+                self.image = cv.imread(image, cv.IMREAD_COLOR)
+                if self.image is None:
+                    raise ValueError('No se pudo leer la imagen.')
+        self.shape = self.image.shape
+
+    def window(self, y0, y1, x0, x1):
+        """ Retorna la ventana [y0:y1,x0:x1] de la imagen en formato BGR """
+        w = self.image[y0:y1,x0:x1,:3]
+        if self.rgb:
+            w = w[:,:,::-1]
+        return np.ascontiguousarray(w)
+
+    def pixels(self, ys, xs):
+        """ Retorna los pixeles de las coordenadas dadas como array de Nx3
+        en formato BGR
+        """
+        p = self.image[ys,xs,:3]
+        if self.rgb:
+            p = p[:,::-1]
+        return np.ascontiguousarray(p)
+
+
+def tiles(shape, tile, overlap):
+    """ Divide una imagen en teselas
+
+    Argumentos:
+        shape -- dimensiones de la imagen
+        tile -- lado de la tesela en pixeles
+        overlap -- solapamiento en pixeles que se agrega a cada lado
+
+    Retorna: lista de pares (núcleo, ventana), cada uno como (y0,y1,x0,x1).
+             Los núcleos cubren la imagen sin solaparse y las ventanas son los
+             núcleos ampliados con el solapamiento
+    """
+    [h,w] = shape[:2]
+    result = []
+    for y0 in range(0, h, tile):
+        for x0 in range(0, w, tile):
+            y1 = min(y0+tile, h)
+            x1 = min(x0+tile, w)
+            window = (max(y0-overlap, 0), min(y1+overlap, h),
+                      max(x0-overlap, 0), min(x1+overlap, w))
+            result.append(((y0,y1,x0,x1),window))
+    return result
+
+
+def global_threshold(image, tile=4096, samples=None, seed=0):
+    """ Calcula un único umbral de Otsu para toda la imagen acumulando el
+    histograma del ExG
+
+    Argumentos:
+        image -- TiledImage
+        tile -- lado de la tesela en pixeles
+        samples -- cantidad de pixeles muestreados al azar. Si es None se
+                   recorren todas las teselas
+        seed -- semilla del muestreo
+
+    Retorna: umbral
+    """
+    [h,w] = image.shape[:2]
+    hist = None
+    if samples is None:
+        for (y0,y1,x0,x1),_ in tiles(image.shape, tile, 0):
+            hist = exg_histogram(image.window(y0, y1, x0, x1), hist)
+    else:
+        rng = np.random.default_rng(seed)
+        # Se ordenan por posición para leer la imagen secuencialmente
+        idx = np.sort(rng.integers(0, h*w, samples))
+        for chunk in np.array_split(idx, max(1, samples // tile**2)):
+            ys,xs = np.divmod(chunk, w)
+            hist = exg_histogram(image.pixels(ys, xs), hist)
+    return otsu_threshold(hist)
+
+
+def tiled_mask(image, ppm, mask_file, tile=4096, overlap=None,
+               threshold=None):
+    """ Segmenta y aplica las operaciones morfológicas por teselas
+
+    Argumentos:
+        image -- TiledImage
+        ppm -- pixeles por metro
+        mask_file -- fichero .npy donde se escribe la máscara
+        tile -- lado de la tesela en pixeles
+        overlap -- solapamiento en pixeles (por defecto un metro)
+        threshold -- umbral del ExG común a todas las teselas (None: cada
+                     tesela usa su propio umbral de Otsu)
+
+    Retorna: máscara mapeada a memoria
+    """
+    if overlap is None:
+        overlap = ppm
+    [h,w] = image.shape[:2]
+    mask = np.lib.format.open_memmap(mask_file, mode='w+', dtype=np.uint8,
+                                     shape=(h,w))
+    for (y0,y1,x0,x1),(wy0,wy1,wx0,wx1) in tiles(image.shape, tile, overlap):
+        window = image.window(wy0, wy1, wx0, wx1)
+        window = morphology(segmentation(window, threshold), ppm)
+        mask[y0:y1,x0:x1] = window[y0-wy0:y1-wy0,x0-wx0:x1-wx0]
+    mask.flush()
+    return mask
+
+
+def tiled_counting(mask, model_file, ppm, orientation, tile=4096,
+                   overlap=None):
+    """ Aplica el modelo por teselas sobre una máscara sin rotar
+
+    Argumentos:
+        mask -- máscara (puede estar mapeada a memoria)
+        model_file -- nombre del fichero del modelo
+        ppm -- pixeles por metro
+        orientation -- orientación de las hileras en grados
+        tile -- lado de la tesela en pixeles
+        overlap -- solapamiento en pixeles (por defecto un metro)
+
+    Retorna: total de plantas, lista de rectángulos con la cantidad de plantas
+        que hay en el mismo, total de hileras, y lineas de las hileras. Los
+        rectángulos y las lineas están en coordenadas de la máscara sin rotar.
+        El total de hileras y de plantas depende del tamaño de la tesela (ver
+        la descripción del módulo)
+    """
+    if overlap is None:
+        overlap = ppm
+    model = Model.cached(model_file)
+    total_plants = 0
+    rects = []
+    lines = []
+    offsets = []
+    for (y0,y1,x0,x1),(wy0,wy1,wx0,wx1) in tiles(mask.shape, tile, overlap):
+        window = np.ascontiguousarray(mask[wy0:wy1,wx0:wx1])
+        if not window.any():
+            continue
+        # Al rotar con vecino más cercano pueden quedar fragmentos en los
+        # bordes de la ventana, se limpian como en el caso sin teselas
+        Minv,_ = rotation_matrix(window.shape, -orientation)
+        window = rotation(window, -orientation, 'nearest')
+        window = morphology(window, ppm)
+        # Desplazamiento de la ventana a coordenadas globales
+        Minv[:,2] += (wx0,wy0)
+
+        # Posición de cada hilera medida sobre la normal a las hileras
+        normal = Minv[:,1] / np.linalg.norm(Minv[:,1])
+        row_centers,_ = rows_centers(window, ppm)
+        for r in row_centers:
+            offsets.append(np.dot(normal, Minv @ (0,r,1)))
+
+        blobs,_,window_lines = rows_detection(window, ppm)
+        if len(blobs) == 0:
+            continue
+
+        # Solo se cuentan los objetos cuyo centroide está en el núcleo. Los
+        # descriptores se calculan sobre la ventana rotada
+        cens = cv.transform(blobs.centroid[None], Minv)[0]
+        inside = ((y0 <= cens[:,1]) & (cens[:,1] < y1) &
+                  (x0 <= cens[:,0]) & (cens[:,0] < x1))
+        blobs = blobs.take(inside)
+        if len(blobs) > 0:
+            n_plants = Model.apply(model, Descriptors.array(blobs, ppm))
+            total_plants += float(n_plants.sum(dtype=np.float64))
+            rects += [(cv.boundingRect(cv.transform(blobs.contour(j), Minv)),
+                       '%.1f' % n_plants[j])
+                      for j in range(len(blobs)) if n_plants[j] > 0]
+
+        for l in window_lines:
+            p = cv.transform(np.array([[l[:2],l[2:]]], np.float64), Minv)[0]
+            if y0 <= p[0,1] < y1 and x0 <= p[0,0] < x1:
+                lines.append(list(p.round().astype(int).flatten()))
+
+    # Las hileras detectadas en varias ventanas se unen si su posición sobre
+    # la normal difiere menos que la distancia mínima entre hileras
+    offsets = np.sort(offsets)
+    total_rows = int(np.count_nonzero(np.diff(offsets) >= ppm/10) +
+                     (len(offsets) > 0))
+
+    return (round(total_plants),rects,total_rows,lines)
+
+
+def tiled_pipeline(image, model_file, ppm, tile=4096, overlap=None,
+                   samples=None, timings=None):
+    """ Segmenta, detecta la orientación de las hileras y cuenta las plantas
+    de una imagen procesándola por teselas
+
+    Argumentos:
+        image -- nombre del fichero de la imagen o array (BGR)
+        model_file -- nombre del fichero del modelo
+        ppm -- pixeles por metro
+        tile -- lado de la tesela en pixeles
+        overlap -- solapamiento en pixeles (por defecto un metro)
+        samples -- cantidad de pixeles muestreados para calcular el umbral
+                   global (None: se usan todos los pixeles)
+        timings -- diccionario donde se guardan los tiempos en segundos de
+                   cada etapa (opcional)
+
+    Retorna: total de plantas, lista de rectángulos, total de hileras, lineas
+             de las hileras y orientación en grados (None si falla la
+             detección de la orientación)
+    """
+    if timings is None:
+        timings = {}
+    t = time.perf_counter()
+    image = TiledImage(image)
+    timings['lectura'] = time.perf_counter() - t
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Umbral único para que todas las teselas se segmenten igual
+        t = time.perf_counter()
+        threshold = global_threshold(image, tile, samples)
+        mask = tiled_mask(image, ppm, os.path.join(tmp_dir, 'mask.npy'),
+                          tile, overlap, threshold)
+        timings['segmentacion'] = time.perf_counter() - t
+
+        # rows_orientation solo lee una ventana central de la máscara
+        t = time.perf_counter()
+        orientation = rows_orientation(mask, ppm=ppm, refine=True)
+        timings['orientacion'] = time.perf_counter() - t
+        if orientation is None:
+            return (0,[],0,[],None)
+
+        t = time.perf_counter()
+        total_plants,rects,total_rows,lines = tiled_counting(
+            mask, model_file, ppm, orientation, tile, overlap)
+        timings['conteo'] = time.perf_counter() - t
+        del mask
+
+    return (total_plants,rects,total_rows,lines,orientation)
+